@@ -0,0 +1,310 @@
+import json
+import platform
+import socket
+import sys
+from argparse import ArgumentParser
+from os import listdir, path
+from selectors import DefaultSelector, EVENT_READ
+from statistics import mean, median
+from tempfile import gettempdir
+from threading import Thread
+from time import perf_counter, sleep, time
+
+import relay_protocol
+from emulator_standin import EmulatorStandin, default_hooks
+
+# Runs the command-to-effect pipeline against emulator_standin.py and writes
+# the timings to a JSON file, so that runs can be compared for regressions.
+BENCHMARKS = ['patch_load', 'patch_round_trip', 'table_read', 'airstrike',
+              'relay']
+BENCHMARK_PORT = 55356
+RELAY_PORT = 55334
+BENCHMARK_USER = 'benchmark'
+QUEUED_AIRSTRIKES = 4
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {'count': len(samples),
+            'mean_ms': mean(samples) * 1000,
+            'median_ms': median(samples) * 1000,
+            'p90_ms': samples[int(0.9 * (len(samples) - 1))] * 1000,
+            'min_ms': samples[0] * 1000,
+            'max_ms': samples[-1] * 1000}
+
+
+def timed(function, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = perf_counter()
+        function()
+        samples.append(perf_counter() - start)
+    return summarize(samples)
+
+
+def patch_filenames():
+    from ramtools import tblpath
+    return sorted(f for f in listdir(tblpath) if f.endswith('.patch'))
+
+
+def bench_patch_load(iterations):
+    from ramtools import LivePatch
+    results = {}
+    for filename in patch_filenames():
+        results[filename] = timed(lambda: LivePatch(None, filename),
+                                  iterations)
+        patch = LivePatch(None, filename)
+        results[filename]['compile'] = timed(
+            patch.generate_patch_from_master, iterations)
+    return results
+
+
+def bench_patch_round_trip(iterations):
+    from ramtools import LivePatch
+    results = {}
+    for filename in patch_filenames():
+        patch = LivePatch(None, filename)
+
+        def round_trip():
+            patch.apply_patch()
+            patch.restore_backup()
+
+        results[filename] = timed(round_trip, iterations)
+    return results
+
+
+def bench_table_read(iterations):
+    from ramtools import TableObject
+    results = {}
+    for obj in sorted(TableObject.__subclasses__(), key=lambda o: o.__name__):
+        def read_all():
+            for o in obj.every:
+                o.read_data()
+
+        results[obj.__name__] = timed(read_all, iterations)
+    return results
+
+
+def bench_airstrike(iterations, standin):
+    import beyond_backseat
+    from ramtools import JOBS
+    # Give every character and monster some HP so that they can be targeted.
+    for i in range(10):
+        standin.write(beyond_backseat.CurrentHPObject.get(i).pointer,
+                      [100, 0])
+        standin.write(beyond_backseat.MaxHPObject.get(i).pointer, [200, 0])
+
+    def airstrike():
+        job = beyond_backseat.LiveAirstrike(
+            'benchmark', 'magic', 0x36, 'enemy', 'all')
+        while not job.finished:
+            job.run()
+
+    def queued_airstrikes():
+        jobs = [beyond_backseat.QueuedAirstrike(
+            'benchmark', 'magic', 0x36, 'enemy', 'all')
+            for _ in range(QUEUED_AIRSTRIKES)]
+        JOBS.extend(jobs)
+        while not all(j.finished for j in jobs):
+            for j in jobs:
+                j.run()
+        for j in jobs:
+            JOBS.remove(j)
+
+    return {'handshake': timed(airstrike, iterations),
+            'queued': timed(queued_airstrikes, iterations)}
+
+
+class SyntheticStreamer():
+    def __init__(self, serial_number, command_table, channel=None,
+                 allowed_users=(BENCHMARK_USER,), port=RELAY_PORT):
+        self.serial_number = serial_number
+        if channel is None:
+            channel = 'benchmark{0}'.format(serial_number)
+        self.channel = channel
+        self.allowed_users = list(allowed_users)
+        self.command_table = list(command_table)
+        self.dictionary = relay_protocol.build_dictionary(self.command_table)
+        self.confirmed = -1
+        self.received = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(('127.0.0.1', port))
+        self.socket.setblocking(False)
+
+    def send(self, message_type, payload=b''):
+        msg = relay_protocol.encode_message(
+            message_type, payload, serial_number=self.serial_number)
+        self.socket.send(msg)
+
+    def keepalive(self):
+        digest = relay_protocol.command_digest(self.command_table)
+        self.send(relay_protocol.KEEPALIVE,
+                  relay_protocol.encode_keepalive(digest))
+
+    def receive(self):
+        msg = self.socket.recv(relay_protocol.MAX_DATAGRAM_LENGTH)
+        message_type, _, payload = relay_protocol.decode_message(
+            msg, dictionary=self.dictionary)
+        if message_type == relay_protocol.REQUEST_REPORT:
+            self.send(relay_protocol.REPORT, relay_protocol.encode_report(
+                self.channel, self.allowed_users, self.command_table))
+        elif message_type == relay_protocol.COMMANDS:
+            now = perf_counter()
+            for index, command in relay_protocol.decode_commands(
+                    payload, self.command_table):
+                if index == self.confirmed + 1:
+                    self.confirmed = index
+                    self.received.append((command, now))
+            self.send(relay_protocol.CONFIRM,
+                      relay_protocol.encode_confirm(self.confirmed))
+
+
+class StreamerPool():
+    # Answers the relay for every synthetic streamer from one thread.
+    def __init__(self, streamers):
+        self.streamers = streamers
+        self.selector = DefaultSelector()
+        for streamer in streamers:
+            self.selector.register(streamer.socket, EVENT_READ, streamer)
+        self.running = False
+
+    @property
+    def delivered(self):
+        return sum(len(s.received) for s in self.streamers)
+
+    def listen(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    key.data.receive()
+                except (BlockingIOError, ConnectionRefusedError):
+                    pass
+
+    def start(self):
+        self.running = True
+        Thread(target=self.listen, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def register(self, server, timeout):
+        channels = set('#{0}'.format(s.channel) for s in self.streamers)
+        start = time()
+        while not channels <= server.get_channels():
+            if time() - start > timeout:
+                raise Exception('Relay did not register every streamer.')
+            for streamer in self.streamers:
+                streamer.keepalive()
+            sleep(0.1)
+            server.poll()
+
+
+def bench_relay(num_clients, num_commands, workers, timeout):
+    sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                                 'server'))
+    import backseat_server
+    backseat_server.SERVER_PORT = RELAY_PORT
+    server = backseat_server.Server(workers=workers)
+    command_table = ['command{0}'.format(i) for i in range(num_commands)]
+    streamers = [SyntheticStreamer(serial_number, command_table)
+                 for serial_number in range(num_clients)]
+    pool = StreamerPool(streamers)
+    pool.start()
+    pool.register(server, timeout)
+
+    delegated = {}
+    start = perf_counter()
+    for command in command_table:
+        for streamer in streamers:
+            delegated[streamer.channel, command] = perf_counter()
+            server.delegate_command('#{0}'.format(streamer.channel),
+                                    BENCHMARK_USER, command)
+    total = num_clients * num_commands
+    while pool.delivered < total:
+        if perf_counter() - start > timeout:
+            break
+        sleep(0.01)
+    elapsed = perf_counter() - start
+    pool.stop()
+
+    latencies = [received - delegated[streamer.channel, command]
+                 for streamer in streamers
+                 for (command, received) in streamer.received]
+    delivered = len(latencies)
+    results = {'delivery': summarize(latencies),
+               'delivered': delivered,
+               'lost': total - delivered,
+               'elapsed_s': elapsed,
+               'commands_per_second': delivered / elapsed}
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the Beyond Backseat '
+                                        'command pipeline.')
+    parser.add_argument('--config', default='beyond.cfg')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--log', default=path.join(gettempdir(),
+                                                   'beyond_benchmark.log'))
+    parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                        help='run only these benchmarks')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--game-delay', type=float, default=0)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--commands', type=int, default=100)
+    parser.add_argument('--relay-workers', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    benchmarks = args.only or BENCHMARKS
+
+    # ramtools reads its configuration file from the command line.
+    sys.argv[1:] = [args.config]
+    standin = EmulatorStandin(port=BENCHMARK_PORT, latency=args.latency,
+                              jitter=args.jitter)
+    default_hooks(standin, delay=args.game_delay)
+    standin.start()
+
+    # The log goes to its own file, not the one next to the program.
+    from ramtools import config
+    config['Misc']['log_file'] = args.log
+    import beyond_backseat
+    from ramtools import client, initialize_ramtools, logger, LivePatch
+
+    logger.print_logs = False
+    client.emulator_port = standin.port
+    initialize_ramtools(vars(beyond_backseat))
+    LivePatch.GLOBAL_DEFINITIONS['XX'] = config['Emulator'].get(
+        'free_space_bank', 'c0')
+    for i in range(4):
+        beyond_backseat.PlayerCharacter()
+    for i in range(6):
+        beyond_backseat.MonsterCharacter()
+
+    results = {}
+    for name in benchmarks:
+        print('Running {0}...'.format(name))
+        if name == 'patch_load':
+            results[name] = bench_patch_load(args.iterations)
+        elif name == 'patch_round_trip':
+            results[name] = bench_patch_round_trip(args.iterations)
+        elif name == 'table_read':
+            results[name] = bench_table_read(args.iterations)
+        elif name == 'airstrike':
+            results[name] = bench_airstrike(args.iterations, standin)
+        elif name == 'relay':
+            results[name] = bench_relay(args.clients, args.commands,
+                                        args.relay_workers, args.timeout)
+
+    report = {'timestamp': int(time()),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'settings': vars(args),
+              'emulator': standin.counters,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to {0}'.format(args.output))
@@ -1,17 +1,28 @@
 import random
 import traceback
 from os import _exit
-from time import sleep, time
+from sys import argv
+from threading import Lock
+from time import perf_counter, sleep, time
 
-from ramtools import (classproperty, client, config, logger, log,
-                      initialize_ramtools, begin_job_management,
-                      LivePatch, TableObject)
+from ramtools import (classproperty, client, close_files, config, logger,
+                      log, initialize_ramtools, begin_job_management,
+                      apply_patches, run_sessions, LivePatch, TableObject,
+                      record_telemetry, current_session, SessionAttribute,
+                      WriteTransaction, JOBS, MIRROR_REGIONS, PROBE_HANDLERS,
+                      SCAN_WATCHES, GLOBAL_DEFINITIONS)
+from metrics import metrics
+from tracing import tracer
 
 
 VERSION = 3
+CHARACTERS_LOCK = Lock()
 
 
-logger.set_logfile('beyond_backseat.log')
+if 'log_file' in config['Misc'] and config['Misc']['log_file']:
+    logger.set_logfile(config['Misc']['log_file'])
+else:
+    logger.set_logfile('beyond_backseat.log')
 if config['Misc']['mode'] == 'manual':
     logger.print_logs = False
 log('Beginning log.')
@@ -121,8 +132,10 @@ class PlayerCharacter():
         raise Exception('Unknown ailment: %s' % name)
 
     def refresh(self):
-        for o in self.hp_objects + self.mp_objects + self.ailment_objects:
-            o.read_data()
+        with tracer.span('refresh', 'character', index=self.offset_index):
+            for o in (self.hp_objects + self.mp_objects
+                      + self.ailment_objects):
+                o.read_data()
 
 
 class MonsterCharacter(PlayerCharacter):
@@ -142,10 +155,12 @@ class LiveMixin(LivePatch):
     LOCK_ADDRESS = 0x7e11e8
     IO_WAIT = 0.02
     MAX_LOCK_WAIT = 10
-    CURRENTS = {}
+    CURRENTS = SessionAttribute('currents')
+    SEMAPHORES = [0x7e11e8, 0x7e11e9]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.created_at = perf_counter()
         self.previous_poll = 0
         self.state = {}
         self.last_update = None
@@ -209,9 +224,49 @@ class LiveMixin(LivePatch):
             return True
         return False
 
+    @property
+    def lock_bits(self):
+        bits = 0
+        for key in ['EVENT', 'READY', 'VERIFY', 'WAIT']:
+            if hasattr(self, key):
+                bits |= getattr(self, key)
+        return bits
+
+    @classmethod
+    def clear_stale_locks(cls, reset=False, missing=()):
+        # Lock bits that no current job owns were left behind by a
+        # savestate or reset. After a reset, jobs caught mid-handshake start
+        # over.
+        address = min(cls.SEMAPHORES)
+        values = client.read_emulator(address, len(cls.SEMAPHORES))
+        for semaphore, value in zip(cls.SEMAPHORES, values):
+            owned = 0
+            for (lock_address, _), job in list(cls.CURRENTS.items()):
+                if lock_address != semaphore or job is None or job.finished:
+                    continue
+                if reset and job.state['event']:
+                    job.reset()
+                else:
+                    owned |= job.lock_bits
+            stale = value & ~owned
+            if stale:
+                # The game may have set bits since the first read, so only
+                # the stale ones are cleared from a fresh read.
+                log('Clearing stale lock bits {0:0>2x} at {1:x}.'.format(
+                    stale, semaphore))
+                value = client.read_emulator(semaphore, 1)[0]
+                client.send_emulator(semaphore, [value & ~stale])
+                metrics.increment('stale_locks_cleared_total')
+
+    def invalidate(self):
+        super().invalidate()
+        if hasattr(self, 'lock'):
+            del self.lock
+
     def get_lock_status(self):
-        sleep(self.IO_WAIT)
-        lock = client.read_emulator(self.LOCK_ADDRESS, 1)[0]
+        with tracer.span('get_lock_status', 'job', job=self.name):
+            sleep(self.IO_WAIT)
+            lock = client.read_emulator(self.LOCK_ADDRESS, 1)[0]
         if hasattr(self, 'lock') and lock != self.lock:
             for key in ['EVENT', 'READY', 'VERIFY', 'WAIT']:
                 if hasattr(self, key):
@@ -238,9 +293,24 @@ class LiveMixin(LivePatch):
             self.lock = (self.lock | bit) ^ bit
             sleep(self.IO_WAIT)
 
+    def commit_transaction(self, transaction, set_bits=0, unset_bits=0):
+        # The lock byte is the trigger, so the game only sees the new bits
+        # once everything it depends on is in place. It is shared, so only
+        # these bits are changed, from a read made right before.
+        transaction.trigger_bits(self.LOCK_ADDRESS, set_bits=set_bits,
+                                 unset_bits=unset_bits)
+        transaction.commit()
+        lock, new_lock = transaction.bits[self.LOCK_ADDRESS]
+        self.lock = new_lock
+        if new_lock != lock:
+            self.last_update = time()
+            sleep(self.IO_WAIT)
+
     def reset(self):
         if self.finished:
             return
+        tracer.instant('reset', 'job', job=self.name, state=str(self))
+        metrics.increment('jobs_reset_total')
         bits = 0
         for key in ['EVENT', 'READY', 'VERIFY', 'WAIT']:
             if hasattr(self, key):
@@ -256,9 +326,14 @@ class LiveMixin(LivePatch):
         now = time()
         delta = now - self.previous_poll
         if delta < self.POLL_INTERVAL:
-            sleep(self.POLL_INTERVAL - delta)
+            with tracer.span('poll_wait', 'job', job=self.name):
+                sleep(self.POLL_INTERVAL - delta)
         self.previous_poll = now
 
+    def transition(self, key):
+        with tracer.span('do_%s' % key, 'job', job=self.name):
+            getattr(self, 'do_%s' % key)()
+
     def poll(self):
         if self.finished:
             if self.is_current:
@@ -268,6 +343,8 @@ class LiveMixin(LivePatch):
         if self.CURRENTS[self.LOCK_KEY] is None:
             self.CURRENTS[self.LOCK_KEY] = self
             assert self.is_current
+            tracer.complete('wait_current', 'job', self.created_at,
+                            perf_counter(), job=self.name)
 
         if not self.is_current:
             return
@@ -278,14 +355,13 @@ class LiveMixin(LivePatch):
 
         old_state = dict(self.state)
         if not (self.state['event'] or lock & self.EVENT):
-            self.do_event()
+            self.transition('event')
 
         if self.state['event']:
             for key in ['READY', 'VERIFY', 'WAIT']:
                 if (hasattr(self, key) and lock & getattr(self, key)
                         and not self.state[key.lower()]):
-                    f = getattr(self, 'do_%s' % key.lower())
-                    f()
+                    self.transition(key.lower())
 
         self.do_extra()
 
@@ -336,17 +412,81 @@ class LiveMixin(LivePatch):
 
 class LiveEvent(LiveMixin):
     def do_ready(self):
-        self.apply_patch()
-        self.unset_lock_bit(self.READY)
+        transaction = WriteTransaction(self.client)
+        transaction.write_patch(self)
+        self.commit_transaction(transaction, unset_bits=self.READY)
+        self.applied_patch = True
         self.state['ready'] = True
 
     def do_wait(self):
-        self.restore_backup()
-        self.unset_lock_bit(self.WAIT)
+        transaction = WriteTransaction(self.client)
+        transaction.write_patch(self, self.backup, force=True)
+        self.commit_transaction(transaction, unset_bits=self.WAIT)
+        self.applied_patch = False
         self.state['wait'] = True
         assert self.finished
 
 
+def choose_targets(target, focus, caster):
+    # Returns (actor index, targeting flags). Either is None if there is
+    # nobody to choose.
+    actor_candidates = None
+    if focus == 'all':
+        if target == 'ally':
+            attack_targets = 0x000f
+        elif target == 'enemy':
+            attack_targets = 0x3f00
+        else:
+            attack_targets = 0x3f0f
+    elif focus in ['random', 'self']:
+        if target not in ['ally', 'enemy']:
+            target = random.choice(['ally', 'enemy'])
+
+        if target == 'ally':
+            candidates = [p for p in PlayerCharacter.every
+                          if p.is_valid_target]
+        elif target == 'enemy':
+            candidates = [m for m in MonsterCharacter.every
+                          if m.is_valid_target]
+
+        if caster == target:
+            actor_candidates = candidates
+
+        if not candidates:
+            return None, None
+
+        chosen_target = random.choice(candidates)
+        attack_targets = chosen_target.targeting_flag
+        if focus == 'self':
+            assert caster == target
+            actor_candidates = [chosen_target]
+    else:
+        raise Exception('Unknown targeting focus.')
+
+    if actor_candidates is None:
+        if caster == 'ally':
+            actor_candidates = [p for p in PlayerCharacter.every
+                                if p.is_valid_target]
+        elif caster == 'enemy':
+            actor_candidates = [m for m in MonsterCharacter.every
+                                if m.is_valid_target]
+        if not actor_candidates:
+            return None, attack_targets
+
+    actor_index = random.choice(actor_candidates).offset_index
+    if caster == 'ally':
+        assert 0 <= actor_index <= 3
+    elif caster == 'enemy':
+        assert 4 <= actor_index <= 9
+
+    if target == 'ally':
+        assert attack_targets & 0x000f
+    elif target == 'enemy':
+        assert attack_targets & 0x3f00
+
+    return actor_index, attack_targets
+
+
 class LiveAirstrike(LiveMixin):
     LOCK_ADDRESS = 0x7e11e8
     VERIFY_COMMAND = 0x7e11ea
@@ -388,63 +528,15 @@ class LiveAirstrike(LiveMixin):
         self.set_label('attack_command', self.attack_command)
         self.set_label('attack_spell', self.attack_spell)
 
-        target, focus = self.target, self.focus
-        actor_candidates = None
-        if focus == 'all':
-            if target == 'ally':
-                attack_targets = 0x000f
-            elif target == 'enemy':
-                attack_targets = 0x3f00
-            else:
-                attack_targets = 0x3f0f
-        elif focus in ['random', 'self']:
-            if target not in ['ally', 'enemy']:
-                target = random.choice(['ally', 'enemy'])
-
-            if target == 'ally':
-                candidates = [p for p in PlayerCharacter.every
-                              if p.is_valid_target]
-            elif target == 'enemy':
-                candidates = [m for m in MonsterCharacter.every
-                              if m.is_valid_target]
-
-            if self.caster == target:
-                actor_candidates = candidates
-
-            if not candidates:
-                self.reset()
-                return
-
-            chosen_target = random.choice(candidates)
-            attack_targets = chosen_target.targeting_flag
-            if focus == 'self':
-                assert self.caster == target
-                actor_candidates = [chosen_target]
-        else:
-            raise Exception('Unknown targeting focus.')
-
-        if actor_candidates is None:
-            if self.caster == 'ally':
-                actor_candidates = [p for p in PlayerCharacter.every
-                                    if p.is_valid_target]
-            elif self.caster == 'enemy':
-                actor_candidates = [m for m in MonsterCharacter.every
-                                    if m.is_valid_target]
-            if not actor_candidates:
-                self.reset()
-                sleep(self.MAX_LOCK_WAIT)
-                return
-
-        actor_index = random.choice(actor_candidates).offset_index
-        if self.caster == 'ally':
-            assert 0 <= actor_index <= 3
-        elif self.caster == 'enemy':
-            assert 4 <= actor_index <= 9
-
-        if target == 'ally':
-            assert attack_targets & 0x000f
-        elif target == 'enemy':
-            assert attack_targets & 0x3f00
+        actor_index, attack_targets = choose_targets(
+            self.target, self.focus, self.caster)
+        if attack_targets is None:
+            self.reset()
+            return
+        if actor_index is None:
+            self.reset()
+            sleep(self.MAX_LOCK_WAIT)
+            return
 
         attack_targets = [attack_targets & 0xff, attack_targets >> 8]
         self.set_label('attack_targets', attack_targets)
@@ -452,22 +544,28 @@ class LiveAirstrike(LiveMixin):
         caaa = int(self.definitions['counterattack_assignments_address'], 0x10)
         caaa_actor = caaa + (actor_index * 2)
 
-        tail = client.read_emulator(
-            self.labels['counterattacker_queue_tail'], 1)[0]
-
-        caqa = int(self.definitions['counterattacker_queue_address'], 0x10)
-        caqa_tail = caqa + tail
-
-        tail = (tail + 1) & 0xff
-        self.set_label('counterattacker_queue_tail', tail)
-        self.state['ready'] = True
-        self.set_lock_bit(self.VERIFY)
-        self.unset_lock_bit(self.WAIT)
-        self.client.send_emulator(self.VERIFY_COMMAND, [self.attack_command,
-                                                        self.attack_spell])
-        self.client.send_emulator(caaa_actor, [0])
-        self.client.send_emulator(caqa_tail, [actor_index * 2])
-        self.apply_patch()
+        with tracer.span('queue_counterattack', 'job', job=self.name):
+            tail = client.read_emulator(
+                self.labels['counterattacker_queue_tail'], 1)[0]
+
+            caqa = int(self.definitions['counterattacker_queue_address'],
+                       0x10)
+            caqa_tail = caqa + tail
+
+            tail = (tail + 1) & 0xff
+            self.set_label('counterattacker_queue_tail', tail)
+            transaction = WriteTransaction(self.client)
+            # The game holds until VERIFY, so these can be read back too.
+            transaction.write(self.VERIFY_COMMAND,
+                              [self.attack_command, self.attack_spell],
+                              confirm=True)
+            transaction.write(caaa_actor, [0], confirm=True)
+            transaction.write(caqa_tail, [actor_index * 2], confirm=True)
+            transaction.write_patch(self)
+            self.commit_transaction(transaction, set_bits=self.VERIFY,
+                                    unset_bits=self.WAIT)
+            self.applied_patch = True
+            self.state['ready'] = True
 
     def do_wait(self):
         self.state['wait'] = True
@@ -482,11 +580,179 @@ class LiveAirstrike(LiveMixin):
             self.reset()
 
 
+def airstrike_queue_enabled():
+    return ('airstrike_queue' in config['Misc']
+            and config['Misc']['airstrike_queue'][:1].lower() == 'y'
+            and current_session().name not in QueuedAirstrike.conflicts)
+
+
+class QueuedAirstrike():
+    # Airstrikes appended to the queue that airstrike_queue.patch drains
+    # into the counterattack queue, so that several can be pending at once
+    # without a handshake each. The queue is a ring of 8-byte entries that
+    # the game empties from the head and the client fills at the tail. The
+    # game opens the queue once a battle is running, marks each entry it
+    # drains, and empties the queue when the battle ends. A lost connection
+    # leaves it alone. The patch explains where the queue lives.
+    QUEUE_HEAD = 0x7ffe00
+    QUEUE_TAIL = QUEUE_HEAD + 1
+    QUEUE_BATTLE = QUEUE_HEAD + 2
+    QUEUE_ENTRIES = QUEUE_HEAD + 8
+    QUEUE_LENGTH = 8
+    ENTRY_LENGTH = 8
+    DRAINED = 5
+    conflicts = set([])
+
+    def __init__(self, name, command=0x02, spell=0x80,
+                 target='enemy', focus='all', caster='ally'):
+        if isinstance(command, str):
+            command = LiveAirstrike.command_names.index(command)
+        self.client = client
+        self.attack_command = command
+        self.attack_spell = spell
+        self.target = target
+        self.focus = focus
+        self.name = name
+        self.caster = caster
+        self.slot = None
+        self.entry = None
+        self.state = {'queued': False, 'wait': False}
+        client.show_message('Airstrike: {0}'.format(name.upper()))
+
+    def __repr__(self):
+        if self.slot is None:
+            return '{0}-{1:x}'.format(self.name, id(self) & 0xffff)
+        return '{0}-{1:x}-queued'.format(self.name, id(self) & 0xffff)
+
+    @property
+    def finished(self):
+        return self.state['wait']
+
+    @property
+    def is_disposable(self):
+        return self.slot is None
+
+    def reset(self):
+        if self.finished:
+            return
+        self.slot = None
+        self.entry = None
+        self.state['queued'] = False
+
+    def invalidate(self):
+        # After a reset or savestate, an entry that no longer holds what was
+        # written is gone from the queue, and goes in again.
+        if self.finished or self.slot is None:
+            return
+        address = self.QUEUE_ENTRIES + (self.slot * self.ENTRY_LENGTH)
+        entry = self.client.read_emulator(address, self.ENTRY_LENGTH)
+        if entry[:self.DRAINED] != self.entry[:self.DRAINED]:
+            self.reset()
+
+    @classmethod
+    def append_pending(cls):
+        # Every pending airstrike goes into the queue with one transaction;
+        # the new tail is only written once the entries are in place.
+        # Outside of battle the game would throw them away at its end.
+        header = client.read_emulator(cls.QUEUE_HEAD,
+                                      cls.QUEUE_ENTRIES - cls.QUEUE_HEAD)
+        head, tail, battle = header[:3]
+        if any(header[3:]):
+            cls.give_up_queue()
+            return
+        if not battle:
+            return
+        transaction = WriteTransaction(client)
+        appended = []
+        new_tail = tail
+        for j in list(JOBS):
+            if (not isinstance(j, cls) or j.slot is not None
+                    or j.finished):
+                continue
+            if (new_tail + 1) % cls.QUEUE_LENGTH == head:
+                break
+            actor_index, attack_targets = choose_targets(
+                j.target, j.focus, j.caster)
+            if actor_index is None or attack_targets is None:
+                continue
+            entry = [actor_index * 2, j.attack_command, j.attack_spell,
+                     attack_targets & 0xff, attack_targets >> 8, 0, 0, 0]
+            transaction.write(
+                cls.QUEUE_ENTRIES + (new_tail * cls.ENTRY_LENGTH), entry,
+                confirm=True)
+            appended.append((j, new_tail, entry))
+            new_tail = (new_tail + 1) % cls.QUEUE_LENGTH
+        if not appended:
+            return
+        with tracer.span('append_airstrikes', 'job', count=len(appended)):
+            # If the battle ended while the entries were written, the game
+            # has emptied the queue, and the new tail would bring them back
+            # for the next battle.
+            transaction.expect(cls.QUEUE_TAIL, [tail, battle])
+            transaction.trigger(cls.QUEUE_TAIL, [new_tail], previous=[tail])
+            if not transaction.commit():
+                return
+        for j, slot, entry in appended:
+            j.slot = slot
+            j.entry = entry
+            j.state['queued'] = True
+        metrics.increment('airstrikes_queued_total', len(appended))
+
+    @classmethod
+    def give_up_queue(cls):
+        # The reserved bytes in the queue header are never written by the
+        # client or the patch, so the game must be using this memory.
+        # Airstrikes that are not in the queue yet go the usual way.
+        log('The game wrote to the airstrike queue at {0:x}; airstrikes '
+            'are no longer queued.'.format(cls.QUEUE_HEAD))
+        metrics.increment('airstrike_queue_conflicts_total')
+        cls.conflicts.add(current_session().name)
+        for j in list(JOBS):
+            if isinstance(j, cls) and j.slot is None and not j.finished:
+                j.state['wait'] = True
+                JOBS.append(LiveAirstrike(j.name, j.attack_command,
+                                          j.attack_spell, j.target, j.focus,
+                                          caster=j.caster))
+
+    @classmethod
+    def clear_stale_queue(cls, reset=False, missing=()):
+        # When airstrike_queue.patch is reapplied, the queue is left over
+        # from before the reset or savestate, so it is emptied along with
+        # the code. Airstrikes that were still in it notice in invalidate.
+        if not any(p.patch_filename == 'airstrike_queue.patch'
+                   for p in missing):
+            return None
+        return [(cls.QUEUE_HEAD, [0] * (
+            cls.QUEUE_ENTRIES - cls.QUEUE_HEAD
+            + cls.QUEUE_LENGTH * cls.ENTRY_LENGTH))]
+
+    def run(self):
+        if self.finished:
+            return
+        if self.slot is None:
+            self.append_pending()
+            return
+        head, tail = self.client.read_emulator(self.QUEUE_HEAD, 2)
+        pending = (tail - head) % self.QUEUE_LENGTH
+        if (self.slot - head) % self.QUEUE_LENGTH < pending:
+            return
+        # An entry that left the queue without being drained was thrown
+        # away at the end of a battle, and goes in again in the next one.
+        address = self.QUEUE_ENTRIES + (self.slot * self.ENTRY_LENGTH)
+        if self.client.read_emulator(address + self.DRAINED, 1)[0]:
+            self.state['wait'] = True
+        else:
+            self.reset()
+
+
 def handler_event(name, patch_filename):
     return LiveEvent(name, patch_filename)
 
 
 def handler_airstrike(name, command, spell, target, focus, caster='ally'):
+    if airstrike_queue_enabled():
+        return QueuedAirstrike(name, command, spell, target, focus,
+                               caster=caster)
     return LiveAirstrike(name, command, spell, target, focus, caster=caster)
 
 
@@ -671,36 +937,107 @@ def handler_rename(name, character_index):
     return le
 
 
+class BattleWatcher():
+    # Follows battles and map changes through the RAM scanner. A battle
+    # starts when monsters appear with HP or the formation changes, and ends
+    # when every monster is at zero HP.
+    FORMATION_ADDRESS = 0x7e11e0
+    MAP_INDEX_ADDRESS = 0x7e1f64
+    MONSTER_HP_ADDRESS = 0x7e3bfc
+    MONSTER_HP_LENGTH = 12
+
+    def __init__(self):
+        self.in_battle = False
+        self.formation = None
+
+    def register(self):
+        SCAN_WATCHES.append((self.FORMATION_ADDRESS, 2, self.on_formation))
+        SCAN_WATCHES.append((self.MAP_INDEX_ADDRESS, 2, self.on_map))
+        SCAN_WATCHES.append((self.MONSTER_HP_ADDRESS, self.MONSTER_HP_LENGTH,
+                             self.on_monster_hp))
+
+    def set_battle(self, in_battle):
+        if in_battle == self.in_battle:
+            return
+        self.in_battle = in_battle
+        telemetry = current_session().telemetry
+        if telemetry is not None:
+            telemetry.active = in_battle
+        if in_battle:
+            log('Battle started: formation %s' % self.formation, debug=True)
+            record_telemetry('battle_start', self.formation)
+            metrics.increment('battles_total')
+        else:
+            log('Battle ended.', debug=True)
+            record_telemetry('battle_end', self.formation)
+
+    def on_formation(self, old, new):
+        self.formation = new[0] | (new[1] << 8)
+        record_telemetry('formation', self.formation)
+        if self.in_battle:
+            self.set_battle(False)
+        self.set_battle(True)
+
+    def on_map(self, old, new):
+        old_map = (old[0] | (old[1] << 8)) & 0x1ff
+        new_map = (new[0] | (new[1] << 8)) & 0x1ff
+        if old_map != new_map:
+            log('Map changed: %x -> %x' % (old_map, new_map), debug=True)
+            record_telemetry('map', (old_map, new_map))
+
+    def on_monster_hp(self, old, new):
+        if any(new) and not any(old):
+            self.set_battle(True)
+        elif not any(new):
+            self.set_battle(False)
+
+
 def main():
     log('You are running Beyond Backseat version %s.' % VERSION, debug=True)
     initialize_ramtools(globals())
     client.send_emulator(LiveEvent.LOCK_ADDRESS, [0])
 
+    # Each emulator may have its free space in a different bank.
     if 'free_space_bank' in config['Emulator']:
-        LivePatch.GLOBAL_DEFINITIONS['XX'] = (
-            config['Emulator']['free_space_bank'])
+        GLOBAL_DEFINITIONS['XX'] = config['Emulator']['free_space_bank']
     else:
-        LivePatch.GLOBAL_DEFINITIONS['XX'] = 'c0'
-    LivePatch(None, 'cleanup_opcode.patch').apply_patch()
-    LivePatch(None, 'inject_event.patch').apply_patch()
-    LivePatch(None, 'battle_wait.patch').apply_patch()
-    LivePatch(None, 'inject_overworld.patch').apply_patch()
-
-    for i in range(4):
-        PlayerCharacter()
-
-    for i in range(6):
-        MonsterCharacter()
+        GLOBAL_DEFINITIONS['XX'] = 'c0'
+    apply_patches(['cleanup_opcode.patch', 'inject_event.patch',
+                   'battle_wait.patch', 'inject_overworld.patch'])
+    PROBE_HANDLERS.append(LiveMixin.clear_stale_locks)
+    if airstrike_queue_enabled():
+        # The queue chains onto battle_wait.patch's code, so it is applied
+        # on its own once that is in place.
+        apply_patches(['airstrike_queue.patch'])
+        PROBE_HANDLERS.append(QueuedAirstrike.clear_stale_queue)
+    MIRROR_REGIONS.append(('semaphores', min(LiveMixin.SEMAPHORES),
+                           len(LiveMixin.SEMAPHORES)))
+    BattleWatcher().register()
+
+    # Characters only point into the tables, so sessions share them.
+    with CHARACTERS_LOCK:
+        if not PlayerCharacter.every:
+            for i in range(4):
+                PlayerCharacter()
+
+            for i in range(6):
+                MonsterCharacter()
 
     begin_job_management()
 
 
 if __name__ == '__main__':
     try:
-        main()
+        if len(argv) > 2:
+            if 'session_pool' in config['Misc']:
+                run_sessions(argv[1:], main, config['Misc']['session_pool'])
+            else:
+                run_sessions(argv[1:], main)
+        else:
+            main()
     except:
         log(traceback.format_exc(), debug=True)
-        logger.logfile.close()
+        close_files()
         try:
             input('Press enter to close this window. ')
         except(KeyboardInterrupt):
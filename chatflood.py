@@ -0,0 +1,221 @@
+import json
+import random
+import sys
+from argparse import ArgumentParser
+from collections import deque
+from datetime import datetime
+from os import environ, path
+from time import perf_counter, sleep
+
+from benchmark import StreamerPool, SyntheticStreamer, summarize
+from logwriter import TIMESTAMP_FORMAT
+
+# Floods Burroughs' plugins with synthetic or recorded chat and follows every
+# command through the relay to simulated streamers over UDP.
+FLOOD_PORT = 55335
+CHATTER = ['pog', 'lol', 'kefka', 'gg', 'nice', 'what', 'is', 'this', 'rng',
+           'that', 'boss', 'go', 'again', 'no', 'yes', 'ultros', 'octopus']
+
+
+def synthesize(channels, users, commands, rate, duration, command_ratio,
+               mention_ratio, seed=None):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(int(rate * duration)):
+        channel = rng.choice(channels)
+        user = 'viewer{0}'.format(rng.randrange(users))
+        roll = rng.random()
+        if roll < command_ratio:
+            msg = '!beyond {0}'.format(rng.choice(commands))
+        elif roll < command_ratio + mention_ratio:
+            msg = 'hi {0}'.format(burroughs.NICKNAME)
+        else:
+            msg = ' '.join(rng.choice(CHATTER)
+                           for _ in range(rng.randint(1, 8)))
+        messages.append((i / rate, channel, user, msg))
+    return messages
+
+
+def load_replay(filename):
+    # Reads the chat log written by the Logger plugin.
+    messages, first = [], None
+    with open(filename) as f:
+        for line in f:
+            try:
+                date, time_of_day, channel, rest = line.rstrip('\n').split(
+                    ' ', 3)
+                user, msg = rest.split(': ', 1)
+                when = datetime.strptime('{0} {1}'.format(date, time_of_day),
+                                         TIMESTAMP_FORMAT).timestamp()
+            except ValueError:
+                continue
+            if first is None:
+                first = when
+            messages.append((when - first, channel, user, msg))
+    return messages
+
+
+def find_commands(messages, backseater):
+    commands = set([])
+    for _, _, _, msg in messages:
+        matched = backseater.regex.match(msg)
+        if matched and backseater.address_regex.search(msg):
+            commands.add(matched.group(2).lower().strip())
+    return sorted(c for c in commands if c)
+
+
+def relay_drops(server):
+    if server.relay is None:
+        return None
+    drops = {'invalid': 0, 'duplicate': 0, 'dropped': 0, 'rate_limited': 0}
+    for c in list(server.relay.clients.values()):
+        drops['invalid'] += c.invalid_commands
+        drops['duplicate'] += c.duplicate_commands
+        drops['dropped'] += c.dropped_commands
+        drops['rate_limited'] += sum(
+            limiter.rejected for limiter in c.rate_limits.values())
+    return drops
+
+
+def flood(messages, streamers, speed, drain):
+    channels = set('#{0}'.format(s.channel) for s in streamers)
+    bot = FloodBot()
+    bot.factory = burroughs.BurroughsFactory(None, 0, channels)
+    backseater = [p for p in burroughs.PLUGINS
+                  if isinstance(p, burroughs.Backseater)][0]
+
+    sent = {}
+    dispatch, lag = [], []
+    command_messages = 0
+    start = perf_counter()
+    for offset, channel, user, msg in messages:
+        due = start + (offset / speed)
+        now = perf_counter()
+        if due > now:
+            sleep(due - now)
+        else:
+            lag.append(now - due)
+        matched = backseater.regex.match(msg)
+        if matched and backseater.address_regex.search(msg):
+            command_messages += 1
+            key = (channel.lstrip('#'), matched.group(2).lower().strip())
+            sent.setdefault(key, deque()).append(perf_counter())
+        before = perf_counter()
+        bot.privmsg('{0}!{0}@{0}.tmi.twitch.tv'.format(user), channel, msg)
+        dispatch.append(perf_counter() - before)
+    elapsed = perf_counter() - start
+    sleep(drain)
+
+    # Match each delivery to the latest chat message that could have caused
+    # it; older ones were deduplicated or dropped along the way.
+    delivery = []
+    for streamer in streamers:
+        for command, received in streamer.received:
+            times = sent.get((streamer.channel, command))
+            while times and len(times) > 1 and times[1] <= received:
+                times.popleft()
+            if times and times[0] <= received:
+                delivery.append(received - times.popleft())
+
+    server = burroughs.Backseater.server
+    drops = relay_drops(server)
+    delivered = len(delivery)
+    accounted = delivered + backseater.user_limiter.rejected
+    if drops is not None:
+        accounted += sum(drops.values())
+    return {'messages': len(messages),
+            'elapsed_s': elapsed,
+            'messages_per_second': len(messages) / elapsed,
+            'command_messages': command_messages,
+            'responses': bot.responses,
+            'stages': {'dispatch': summarize(dispatch),
+                       'lag': summarize(lag),
+                       'delivery': summarize(delivery)},
+            'drops': {'user_limited': backseater.user_limiter.rejected,
+                      'relay': drops,
+                      'unaccounted': (command_messages - accounted
+                                      if drops is not None else None)},
+            'delivered': delivered}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Flood Burroughs and the relay with '
+                                        'chat traffic.')
+    parser.add_argument('--replay', help='chat log written by the Logger '
+                                         'plugin')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='replay speed multiplier')
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--users', type=int, default=2000,
+                        help='distinct viewers')
+    parser.add_argument('--commands', type=int, default=40,
+                        help='distinct commands')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='messages per second over all channels')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--command-ratio', type=float, default=0.3)
+    parser.add_argument('--mention-ratio', type=float, default=0.02)
+    parser.add_argument('--relay-workers', type=int, default=1)
+    parser.add_argument('--drain', type=float, default=2,
+                        help='seconds to wait for deliveries at the end')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', help='write the results to this JSON '
+                                         'file')
+    args = parser.parse_args()
+
+    # Burroughs binds its relay and reads its password when imported.
+    sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                                 'server'))
+    environ.setdefault('BURROUGHS_PASSWORD', '')
+    environ['BACKSEAT_WORKERS'] = str(args.relay_workers)
+    import backseat_server
+    backseat_server.SERVER_PORT = FLOOD_PORT
+    import burroughs
+
+    class FloodBot(burroughs.Burroughs):
+        responses = 0
+
+        def msg(self, user, message, length=None):
+            self.responses += 1
+
+    backseater = [p for p in burroughs.PLUGINS
+                  if isinstance(p, burroughs.Backseater)][0]
+    if args.replay:
+        messages = load_replay(args.replay)
+        channels = sorted(set(channel for _, channel, _, _ in messages))
+        commands = find_commands(messages, backseater)
+    else:
+        channels = ['#flood{0}'.format(i) for i in range(args.channels)]
+        commands = ['command{0}'.format(i) for i in range(args.commands)]
+        messages = synthesize(channels, args.users, commands, args.rate,
+                              args.duration, args.command_ratio,
+                              args.mention_ratio, seed=args.seed)
+
+    streamers = [SyntheticStreamer(i, commands, channel=channel.lstrip('#'),
+                                   allowed_users=['*'], port=FLOOD_PORT)
+                 for (i, channel) in enumerate(channels)]
+    pool = StreamerPool(streamers)
+    pool.start()
+    pool.register(burroughs.Backseater.server, timeout=30)
+    print('Sending {0} messages to {1} channels...'.format(
+        len(messages), len(channels)))
+    results = flood(messages, streamers, args.speed, args.drain)
+    pool.stop()
+
+    stages = results['stages']
+    print('{0} messages in {1:.2f}s ({2:.0f}/s), {3} commands, '
+          '{4} delivered'.format(results['messages'], results['elapsed_s'],
+                                 results['messages_per_second'],
+                                 results['command_messages'],
+                                 results['delivered']))
+    for stage in ['dispatch', 'lag', 'delivery']:
+        s = stages[stage]
+        if s['count']:
+            print('  {0:<9} n={1:<7} median={2:.3f}ms p90={3:.3f}ms '
+                  'max={4:.3f}ms'.format(stage, s['count'], s['median_ms'],
+                                         s['p90_ms'], s['max_ms']))
+    print('  drops     {0}'.format(results['drops']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
@@ -0,0 +1,404 @@
+import asyncio
+import random
+from argparse import ArgumentParser
+from threading import Thread
+from time import sleep, time
+
+from iorecord import read_exchanges
+
+# A stand-in for RetroArch's network command interface. It keeps the whole
+# 24-bit SNES address space in memory, answers the same text protocol on
+# UDP, and imitates the game side of the lock bytes so that jobs can be run
+# without an emulator or a ROM.
+ADDRESS_SPACE = 0x1000000
+ROM_ADDRESS = 0xc00000
+EMULATOR_IP = '127.0.0.1'
+EMULATOR_PORT = 55355
+FRAME_INTERVAL = 1 / 60
+CONTENT = 'super_nes,Final Fantasy III (USA),crc32=a27f1c7a'
+
+
+class GameHook():
+    # Hooks are stepped once per frame. Each subclass imitates a piece of
+    # patched game code polling a lock byte in step(standin, now). Hooks
+    # without a step, like this base class, are skipped.
+    def __init__(self, address, delay=0):
+        self.address = address
+        self.delay = delay
+        self.enabled = True
+        self.waiting_since = None
+
+    def waited(self, now):
+        if self.waiting_since is None:
+            self.waiting_since = now
+        if now - self.waiting_since >= self.delay:
+            self.waiting_since = None
+            return True
+        return False
+
+
+class BattleLockHook(GameHook):
+    # Mirrors battle_airstrike.patch and battle_wait.patch.
+    EVENT, READY, VERIFY, WAIT = 0x04, 0x02, 0x01, 0x08
+    VERIFY_COMMAND = 0x7e11ea
+    ATTACK_COMMAND = 0x7e3420
+
+    def __init__(self, address=0x7e11e8, delay=0.5):
+        super().__init__(address, delay)
+
+    def step(self, standin, now):
+        lock = standin.memory[self.address]
+        bits = self.EVENT | self.READY | self.VERIFY | self.WAIT
+        if (lock & bits) == self.EVENT:
+            # A character's turn comes up and is held for the airstrike.
+            if self.waited(now):
+                standin.memory[self.address] = lock | self.READY
+        elif lock & self.VERIFY and lock & self.READY:
+            # The counterattack executes once the queued command matches.
+            # 00 00 and ff ff are what the client and game write to clear it.
+            verify = standin.read(self.VERIFY_COMMAND, 2)
+            if (verify not in ([0, 0], [0xff, 0xff])
+                    and verify == standin.read(self.ATTACK_COMMAND, 2)):
+                if self.waited(now):
+                    standin.memory[self.address] = lock & ~self.READY
+                    standin.write(self.VERIFY_COMMAND, [0xff, 0xff])
+        elif lock & self.VERIFY and not lock & (self.READY | self.WAIT):
+            standin.memory[self.address] = (lock | self.WAIT) & ~self.VERIFY
+        else:
+            self.waiting_since = None
+
+
+class EventLockHook(GameHook):
+    # Mirrors inject_event.patch and cleanup_opcode.patch. The overworld
+    # lock at 0x7e11e9 uses the same bits.
+    EVENT, READY, WAIT = 0x40, 0x20, 0x80
+
+    def __init__(self, address=0x7e11e8, delay=0.5):
+        super().__init__(address, delay)
+        self.phase = None
+
+    def step(self, standin, now):
+        lock = standin.memory[self.address]
+        if not lock & self.EVENT:
+            self.phase = None
+            self.waiting_since = None
+        elif self.phase is None:
+            if not lock & (self.READY | self.WAIT):
+                standin.memory[self.address] = lock | self.READY
+                self.phase = 'ready'
+        elif self.phase == 'ready':
+            if not lock & self.READY:
+                self.phase = 'event'
+        elif self.phase == 'event':
+            # The injected event plays out, then the cleanup opcode runs.
+            if self.waited(now):
+                standin.memory[self.address] = lock | self.WAIT
+                self.phase = 'cleanup'
+        elif self.phase == 'cleanup':
+            if not lock & self.WAIT:
+                standin.memory[self.address] = lock & ~self.EVENT
+                self.phase = None
+
+
+class AirstrikeQueueHook(GameHook):
+    # Mirrors the queue drain in airstrike_queue.patch: one entry moves into the
+    # counterattack queue each time the game checks it. A battle is running
+    # while any monster has HP, and the queue is emptied when it ends.
+    QUEUE_HEAD = 0x7ffe00
+    QUEUE_TAIL = QUEUE_HEAD + 1
+    QUEUE_BATTLE = QUEUE_HEAD + 2
+    QUEUE_ENTRIES = QUEUE_HEAD + 8
+    QUEUE_LENGTH = 8
+    ENTRY_LENGTH = 8
+    DRAINED = 5
+    COUNTERATTACK_QUEUE = 0x7e3920
+    COUNTERATTACK_QUEUE_TAIL = 0x7e3a69
+    MONSTER_HP = 0x7e3bfc
+
+    def __init__(self, address=QUEUE_HEAD, delay=0.5):
+        super().__init__(address, delay)
+        self.drained = 0
+
+    def step(self, standin, now):
+        if not any(standin.read(self.MONSTER_HP, 12)):
+            if standin.memory[self.QUEUE_BATTLE]:
+                standin.memory[self.QUEUE_HEAD] = (
+                    standin.memory[self.QUEUE_TAIL])
+                standin.memory[self.QUEUE_BATTLE] = 0
+            self.waiting_since = None
+            return
+        standin.memory[self.QUEUE_BATTLE] = 1
+        head, tail = standin.read(self.QUEUE_HEAD, 2)
+        if head == tail:
+            self.waiting_since = None
+            return
+        if not self.waited(now):
+            return
+        address = self.QUEUE_ENTRIES + (head * self.ENTRY_LENGTH)
+        actor, command, spell, low, high = standin.read(address, 5)
+        standin.write(0x7e3420 + actor, [command, spell])
+        standin.write(0x7e3520 + actor, [low, high])
+        standin.write(0x7e3620 + actor, [0, 0])
+        standin.write(0x7e32cd + actor, [0])
+        standin.memory[address + self.DRAINED] = 1
+        counter_tail = standin.memory[self.COUNTERATTACK_QUEUE_TAIL]
+        standin.memory[self.COUNTERATTACK_QUEUE + counter_tail] = actor
+        standin.memory[self.COUNTERATTACK_QUEUE_TAIL] = (
+            (counter_tail + 1) & 0xff)
+        standin.memory[self.QUEUE_HEAD] = (head + 1) % self.QUEUE_LENGTH
+        self.drained += 1
+
+
+class ReplayHook(GameHook):
+    # Plays back a recorded session. Memory follows what the emulator
+    # answered at each point in the recording, and requests take as long to
+    # answer, or go unanswered, as they did then. The client's own writes
+    # are left for the live client to make.
+    def __init__(self, filename, speed=1):
+        super().__init__(None)
+        self.exchanges = read_exchanges(filename)
+        self.speed = speed
+        self.index = 0
+        self.started = None
+        self.latency, self.loss = None, None
+
+    def step(self, standin, now):
+        if self.started is None:
+            self.started = now
+            self.latency, self.loss = standin.latency, standin.loss
+        elapsed = (now - self.started) * self.speed
+        while (self.index < len(self.exchanges)
+                and self.exchanges[self.index][0] <= elapsed):
+            sent, latency, request, response = self.exchanges[self.index]
+            self.index += 1
+            parts = request.split()
+            if parts and parts[0] == b'READ_CORE_RAM' and response:
+                data = response.split()[2:]
+                if b'-1' not in data:
+                    standin.write(int(parts[1], 0x10),
+                                  [int(d, 0x10) for d in data])
+            if latency is not None:
+                standin.latency = latency / self.speed
+                standin.loss = self.loss if response is not None else 1
+        if self.index >= len(self.exchanges):
+            standin.latency, standin.loss = self.latency, self.loss
+            self.enabled = False
+
+
+class StandinProtocol(asyncio.DatagramProtocol):
+    def __init__(self, standin):
+        self.standin = standin
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.standin.receive(self.transport, data, addr)
+
+
+class EmulatorStandin():
+    def __init__(self, address=EMULATOR_IP, port=EMULATOR_PORT, latency=0,
+                 jitter=0, loss=0, reorder=0, status='PLAYING', seed=None):
+        self.address = address
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.status = status
+        self.random = random.Random(seed)
+        self.memory = bytearray(ADDRESS_SPACE)
+        self.hooks = []
+        self.listeners = []
+        self.messages = []
+        self.counters = {'reads': 0, 'writes': 0, 'read_bytes': 0,
+                         'write_bytes': 0, 'dropped': 0, 'reordered': 0}
+        self.loop = None
+        self.transport = None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def add_listener(self, listener):
+        # Listeners are called with (timestamp, request, response) for every
+        # command the stand-in answers.
+        self.listeners.append(listener)
+
+    def load_rom(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if len(data) % 0x8000 == 0x200:
+            data = data[0x200:]
+        data = data[:ADDRESS_SPACE - ROM_ADDRESS]
+        self.memory[ROM_ADDRESS:ROM_ADDRESS+len(data)] = data
+
+    def read(self, address, num_bytes):
+        return list(self.memory[address:address+num_bytes])
+
+    def write(self, address, data):
+        self.memory[address:address+len(data)] = bytes(data)
+
+    def step_hooks(self, now=None):
+        if now is None:
+            now = time()
+        for hook in self.hooks:
+            if hook.enabled and hasattr(hook, 'step'):
+                hook.step(self, now)
+
+    def execute(self, request):
+        parts = request.decode('ascii', 'replace').strip().split()
+        if not parts:
+            return None
+        command, args = parts[0], parts[1:]
+        if command == 'GET_STATUS':
+            if self.status == 'PLAYING':
+                return 'GET_STATUS PLAYING {0}'.format(CONTENT)
+            return 'GET_STATUS {0}'.format(self.status)
+        if command == 'READ_CORE_RAM':
+            address, num_bytes = int(args[0], 0x10), int(args[1])
+            self.counters['reads'] += 1
+            if (self.status != 'PLAYING'
+                    or address + num_bytes > ADDRESS_SPACE):
+                return 'READ_CORE_RAM {0} -1'.format(args[0])
+            self.counters['read_bytes'] += num_bytes
+            data = ' '.join('{0:0>2x}'.format(d)
+                            for d in self.read(address, num_bytes))
+            return 'READ_CORE_RAM {0} {1}'.format(args[0], data)
+        if command == 'WRITE_CORE_RAM':
+            address = int(args[0], 0x10)
+            data = [int(d, 0x10) for d in args[1:]]
+            self.counters['writes'] += 1
+            if (self.status == 'PLAYING'
+                    and address + len(data) <= ADDRESS_SPACE):
+                self.counters['write_bytes'] += len(data)
+                self.write(address, data)
+            return None
+        if command == 'SHOW_MSG':
+            self.messages.append(' '.join(args))
+            return None
+        return None
+
+    def respond(self, transport, request, addr):
+        response = self.execute(request)
+        if response is not None:
+            response = (response + '\n').encode()
+            transport.sendto(response, addr)
+        now = time()
+        for listener in self.listeners:
+            listener(now, request, response)
+
+    def receive(self, transport, data, addr):
+        if self.loss and self.random.random() < self.loss:
+            self.counters['dropped'] += 1
+            return
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            # Hold this datagram back long enough for later ones to pass it.
+            self.counters['reordered'] += 1
+            delay += self.latency + self.jitter + FRAME_INTERVAL
+        if delay > 0:
+            self.loop.call_later(delay, self.respond, transport, data, addr)
+        else:
+            self.respond(transport, data, addr)
+
+    def tick(self):
+        self.step_hooks()
+        self.loop.call_later(FRAME_INTERVAL, self.tick)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: StandinProtocol(self),
+            local_addr=(self.address, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.tick()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.serve())
+        loop.run_forever()
+
+    def start(self):
+        # Runs the stand-in in a background thread, for use in-process.
+        Thread(target=self.run, daemon=True).start()
+        while self.transport is None:
+            sleep(0.01)
+        return self
+
+    def close(self):
+        # The socket is released by a callback, which has to run before the
+        # loop stops.
+        self.transport.close()
+        self.loop.call_soon(self.loop.stop)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.close)
+
+
+def default_hooks(standin, delay=0.5):
+    standin.add_hook(BattleLockHook(delay=delay))
+    standin.add_hook(AirstrikeQueueHook(delay=delay))
+    standin.add_hook(EventLockHook(delay=delay))
+    standin.add_hook(EventLockHook(address=0x7e11e9, delay=delay))
+
+
+def load_script(standin, filename):
+    # A script is a Python file defining setup(standin), which can add
+    # hooks, poke memory or replace the default game behavior.
+    namespace = {'__file__': filename}
+    with open(filename) as f:
+        exec(compile(f.read(), filename, 'exec'), namespace)
+    namespace['setup'](standin)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='RetroArch network command '
+                                        'stand-in for Beyond Backseat.')
+    parser.add_argument('--address', default=EMULATOR_IP)
+    parser.add_argument('--port', type=int, default=EMULATOR_PORT)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every datagram')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random extra seconds up to this much')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='fraction of datagrams dropped')
+    parser.add_argument('--reorder', type=float, default=0,
+                        help='fraction of datagrams delivered late')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--status', default='PLAYING',
+                        choices=['PLAYING', 'PAUSED', 'CONTENTLESS'])
+    parser.add_argument('--rom', help='headerless or headered HiROM image')
+    parser.add_argument('--game-delay', type=float, default=0.5,
+                        help='seconds the game takes to answer a lock bit')
+    parser.add_argument('--no-hooks', action='store_true')
+    parser.add_argument('--replay', help='session recorded with the '
+                                         'record_file option')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='replay speed multiplier')
+    parser.add_argument('--script', action='append', default=[])
+    args = parser.parse_args()
+
+    standin = EmulatorStandin(args.address, args.port, latency=args.latency,
+                              jitter=args.jitter, loss=args.loss,
+                              reorder=args.reorder, status=args.status,
+                              seed=args.seed)
+    if args.rom:
+        standin.load_rom(args.rom)
+    if args.replay:
+        standin.add_hook(ReplayHook(args.replay, speed=args.speed))
+    elif not args.no_hooks:
+        default_hooks(standin, delay=args.game_delay)
+    for script in args.script:
+        load_script(standin, script)
+    print('Emulator stand-in listening on {0}:{1}'.format(
+        standin.address, standin.port))
+    try:
+        standin.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,150 @@
+import gzip
+import struct
+from argparse import ArgumentParser
+from threading import Lock
+from time import sleep, time
+
+# A session file is gzipped: a magic string and the start time, then one
+# record per datagram exchanged with the emulator. Each record holds the
+# microseconds since the previous record, its kind and the raw datagram.
+MAGIC = b'BBIO\x01'
+START = struct.Struct('<d')
+RECORD = struct.Struct('<IBH')
+REQUEST, RESPONSE, TIMEOUT = 0, 1, 2
+MAX_DELTA = 0xffffffff
+
+
+class Recorder():
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.file = gzip.open(filename, 'wb')
+        self.previous = time()
+        self.last_flush = self.previous
+        self.file.write(MAGIC + START.pack(self.previous))
+
+    def record(self, kind, data=b''):
+        with self.lock:
+            if self.file is None:
+                return
+            now = time()
+            delta = min(int(round((now - self.previous) * 1000000)),
+                        MAX_DELTA)
+            self.previous += delta / 1000000
+            self.file.write(RECORD.pack(delta, kind, len(data)) + data)
+            # A sync flush keeps everything up to here readable even if the
+            # program is killed.
+            if now - self.last_flush >= self.FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_session(filename):
+    # Yields (seconds since the start, kind, datagram). A session cut short
+    # by a crash is read up to the last complete record.
+    with gzip.open(filename, 'rb') as f:
+        try:
+            header = f.read(len(MAGIC) + START.size)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not an emulator session: %s' % filename)
+            elapsed = 0
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                delta, kind, length = RECORD.unpack(record)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                elapsed += delta / 1000000
+                yield elapsed, kind, data
+        except (EOFError, gzip.BadGzipFile):
+            return
+
+
+def read_exchanges(filename):
+    # Pairs each request with the response or timeout that followed it, as
+    # (sent, latency, request, response). Writes and messages get no reply.
+    exchanges, pending = [], None
+    for elapsed, kind, data in read_session(filename):
+        if kind == REQUEST:
+            if pending is not None:
+                exchanges.append(pending)
+            pending = [elapsed, None, data, None]
+        elif pending is not None:
+            pending[1] = elapsed - pending[0]
+            if kind == RESPONSE:
+                pending[3] = data
+            exchanges.append(pending)
+            pending = None
+    if pending is not None:
+        exchanges.append(pending)
+    return [tuple(e) for e in exchanges]
+
+
+def replay_requests(client, filename, speed=1):
+    # Sends the recorded requests through a ParityClient on the recorded
+    # schedule, and returns the latency of each one.
+    exchanges = read_exchanges(filename)
+    latencies = []
+    start = time()
+    for sent, _, request, _ in exchanges:
+        delay = start + (sent / speed) - time()
+        if delay > 0:
+            sleep(delay)
+        parts = request.decode('ascii', 'replace').split()
+        if not parts:
+            continue
+        before = time()
+        if parts[0] == 'READ_CORE_RAM':
+            client.read_emulator(int(parts[1], 0x10), int(parts[2]))
+        elif parts[0] == 'WRITE_CORE_RAM':
+            client.send_emulator(int(parts[1], 0x10),
+                                 [int(d, 0x10) for d in parts[2:]])
+        elif parts[0] == 'GET_STATUS':
+            client.get_status()
+        else:
+            continue
+        latencies.append(time() - before)
+    return latencies
+
+
+def summarize_session(filename):
+    exchanges = read_exchanges(filename)
+    commands = {}
+    for _, latency, request, response in exchanges:
+        name = request.split(b' ', 1)[0].decode('ascii', 'replace')
+        if name not in commands:
+            commands[name] = {'count': 0, 'timeouts': 0, 'latencies': []}
+        commands[name]['count'] += 1
+        if latency is not None and response is None:
+            commands[name]['timeouts'] += 1
+        elif latency is not None:
+            commands[name]['latencies'].append(latency)
+    duration = exchanges[-1][0] if exchanges else 0
+    print('{0}: {1} requests over {2:.1f}s'.format(
+        filename, len(exchanges), duration))
+    for name, c in sorted(commands.items()):
+        latencies = sorted(c['latencies'])
+        s = '  {0:<15} {1:>7} requests {2:>5} timeouts'.format(
+            name, c['count'], c['timeouts'])
+        if latencies:
+            s += '  median {0:.2f}ms  max {1:.2f}ms'.format(
+                latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000)
+        print(s)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Summarize a recorded emulator '
+                                        'session.')
+    parser.add_argument('session')
+    args = parser.parse_args()
+    summarize_session(args.session)
@@ -0,0 +1,107 @@
+from datetime import datetime
+from os import path, remove, rename
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import time
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+_timestamp_cache = [None, '']
+_timestamp_lock = Lock()
+
+
+def timestamp(now=None):
+    # strftime is only called once per second; every other log line in
+    # that second reuses the cached string.
+    if now is None:
+        now = time()
+    second = int(now)
+    with _timestamp_lock:
+        if second != _timestamp_cache[0]:
+            _timestamp_cache[0] = second
+            _timestamp_cache[1] = datetime.fromtimestamp(second).strftime(
+                TIMESTAMP_FORMAT)
+        return _timestamp_cache[1]
+
+
+class LogWriter():
+    FLUSH_INTERVAL = 1
+    FLUSH_SIZE = 64 * 1024
+    MAX_BYTES = 16 * 1024 * 1024
+    BACKUP_COUNT = 3
+    FLUSH = object()
+
+    def __init__(self, filename, max_bytes=MAX_BYTES,
+                 backup_count=BACKUP_COUNT):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = Queue()
+        self.logfile = open(self.filename, 'a+')
+        self.size = self.logfile.tell()
+        self.closed = False
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, s):
+        if not self.closed:
+            self.queue.put(s)
+
+    def rotate(self):
+        self.logfile.close()
+        for i in range(self.backup_count, 0, -1):
+            source = self.filename if i == 1 else '{0}.{1}'.format(
+                self.filename, i-1)
+            target = '{0}.{1}'.format(self.filename, i)
+            if path.exists(source):
+                if path.exists(target):
+                    remove(target)
+                rename(source, target)
+        self.logfile = open(self.filename, 'a+')
+        self.size = 0
+
+    def write_buffer(self, buffer):
+        s = ''.join(buffer)
+        if self.max_bytes and self.size + len(s) > self.max_bytes:
+            self.rotate()
+        self.logfile.write(s)
+        self.logfile.flush()
+        self.size += len(s)
+
+    def run(self):
+        buffer, buffer_size = [], 0
+        last_flush = time()
+        running = True
+        while running:
+            try:
+                s = self.queue.get(timeout=self.FLUSH_INTERVAL)
+            except Empty:
+                s, received = '', False
+            else:
+                received = True
+            if s is None:
+                running = False
+            elif s and s is not self.FLUSH:
+                buffer.append(s)
+                buffer_size += len(s)
+            now = time()
+            if buffer and (not running or s is self.FLUSH
+                           or buffer_size >= self.FLUSH_SIZE
+                           or now - last_flush >= self.FLUSH_INTERVAL):
+                self.write_buffer(buffer)
+                buffer, buffer_size = [], 0
+                last_flush = now
+            if received:
+                self.queue.task_done()
+        self.logfile.close()
+
+    def flush(self):
+        if not self.closed:
+            self.queue.put(self.FLUSH)
+            self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
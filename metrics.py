@@ -0,0 +1,102 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+PREFIX = 'beyond_'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('{0}="{1}"'.format(k, str(v).replace('"', "'"))
+                             for (k, v) in sorted(labels))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Metrics():
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.collectors = []
+        self.server = None
+        self.labeller = None
+
+    def set_labeller(self, labeller):
+        # labeller() returns labels added to every counter, such as the
+        # session the counting thread belongs to.
+        self.labeller = labeller
+
+    def increment(self, name, value=1, **labels):
+        if self.labeller is not None:
+            labels = dict(self.labeller(), **labels)
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self.increment('%s_sum' % name, value, **labels)
+        self.increment('%s_count' % name, 1, **labels)
+
+    def add_collector(self, collector):
+        # A collector is called at scrape time and returns a list of
+        # (name, labels, value) gauges.
+        self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+        lines = []
+        previous_name = None
+        for (name, labels), value in counters:
+            if name != previous_name:
+                lines.append('# TYPE {0}{1} counter'.format(PREFIX, name))
+                previous_name = name
+            lines.append('{0}{1}{2} {3}'.format(
+                PREFIX, name, format_labels(labels), value))
+        for collector in self.collectors:
+            previous_name = None
+            for name, labels, value in collector():
+                if name != previous_name:
+                    lines.append('# TYPE {0}{1} gauge'.format(PREFIX, name))
+                    previous_name = name
+                lines.append('{0}{1}{2} {3}'.format(
+                    PREFIX, name, format_labels(sorted(labels.items())),
+                    value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address='127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        # Sessions on threads share one server; the first one starts it.
+        with self.lock:
+            if self.server is not None:
+                return False
+            self.server = ThreadingHTTPServer((address, int(port)),
+                                              MetricsHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return True
+
+
+metrics = Metrics()
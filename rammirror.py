@@ -0,0 +1,195 @@
+import mmap
+import struct
+from argparse import ArgumentParser
+from multiprocessing import resource_tracker, shared_memory
+from time import sleep, time
+
+# A mirror holds a header, a table of regions and then the region data. The
+# sequence number is odd while the writer is updating the data, so a reader
+# has a consistent snapshot when it sees the same even number before and
+# after reading.
+MAGIC = b'BBRM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHId')
+REGION = struct.Struct('<32sII')
+SEQUENCE = struct.Struct('<I')
+SEQUENCE_OFFSET = 8
+UPDATED = struct.Struct('<d')
+UPDATED_OFFSET = 12
+CREATED = set([])
+
+
+def open_buffer(name, filename, size=None):
+    # Returns (shared memory or None, buffer). Without a size, an existing
+    # mirror is opened.
+    if filename is not None:
+        with open(filename, 'r+b' if size is None else 'w+b') as f:
+            if size is not None:
+                f.truncate(size)
+            return None, mmap.mmap(f.fileno(), 0)
+    if size is None:
+        shm = shared_memory.SharedMemory(name=name)
+        # Attached segments are registered too, and would be removed when
+        # this process exits.
+        if name not in CREATED:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm, shm.buf
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    CREATED.add(name)
+    return shm, shm.buf
+
+
+class RamMirror():
+    def __init__(self, regions, name=None, filename=None):
+        self.regions = []
+        offset = HEADER.size + (REGION.size * len(regions))
+        for region_name, address, length in regions:
+            self.regions.append((region_name, address, length, offset))
+            offset += length
+        self.size = offset
+        self.sequence = 0
+        self.shm, self.buffer = open_buffer(name, filename, self.size)
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, len(self.regions),
+                         self.sequence, 0)
+        for i, (region_name, address, length, _) in enumerate(self.regions):
+            REGION.pack_into(self.buffer, HEADER.size + (REGION.size * i),
+                             region_name.encode()[:32], address, length)
+
+    @property
+    def ranges(self):
+        return [(address, length) for (_, address, length, _) in self.regions]
+
+    def update(self, values):
+        # values holds the data for each region, in order.
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+        for (_, _, length, offset), data in zip(self.regions, values):
+            self.buffer[offset:offset+length] = bytes(data)
+        UPDATED.pack_into(self.buffer, UPDATED_OFFSET, time())
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        if self.shm is not None:
+            self.buffer = None
+            self.shm.close()
+            self.shm.unlink()
+        else:
+            self.buffer.close()
+
+
+class MirrorReader():
+    RETRY_INTERVAL = 0.0001
+    MAX_ATTEMPTS = 10000
+
+    def __init__(self, name=None, filename=None):
+        self.shm, self.buffer = open_buffer(name, filename)
+        magic, version, num_regions, _, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a RAM mirror: %s' % (filename or name))
+        self.regions = {}
+        for i in range(num_regions):
+            region_name, address, length = REGION.unpack_from(
+                self.buffer, HEADER.size + (REGION.size * i))
+            self.regions[region_name.rstrip(b'\0').decode()] = (address,
+                                                                length)
+        offset = HEADER.size + (REGION.size * num_regions)
+        self.offsets = {}
+        for region_name, (address, length) in self.regions.items():
+            self.offsets[region_name] = offset
+            offset += length
+
+    @property
+    def sequence(self):
+        return SEQUENCE.unpack_from(self.buffer, SEQUENCE_OFFSET)[0]
+
+    @property
+    def updated(self):
+        return UPDATED.unpack_from(self.buffer, UPDATED_OFFSET)[0]
+
+    def view(self, region_name):
+        # A view into the mirror without copying. Compare the sequence
+        # number from before and after using it to be sure it was not
+        # updated in between.
+        offset = self.offsets[region_name]
+        _, length = self.regions[region_name]
+        return memoryview(self.buffer)[offset:offset+length]
+
+    def read(self, region_names=None):
+        # Returns (sequence, {region name: bytes}) from a single update.
+        if region_names is None:
+            region_names = list(self.regions)
+        for _ in range(self.MAX_ATTEMPTS):
+            before = self.sequence
+            if before % 2 == 0:
+                values = {}
+                for region_name in region_names:
+                    with self.view(region_name) as view:
+                        values[region_name] = bytes(view)
+                if self.sequence == before:
+                    return before, values
+            sleep(self.RETRY_INTERVAL)
+        raise IOError('RAM mirror is not being updated consistently.')
+
+    def read_address(self, address, num_bytes):
+        for region_name, (start, length) in self.regions.items():
+            if start <= address and address + num_bytes <= start + length:
+                _, values = self.read([region_name])
+                data = values[region_name]
+                return list(data[address-start:address-start+num_bytes])
+        raise KeyError('Address not mirrored: {0:x}'.format(address))
+
+    def wait(self, sequence, timeout=None):
+        # Blocks until the mirror has been updated past the given sequence.
+        start = time()
+        while self.sequence <= sequence + 1:
+            if timeout is not None and time() - start > timeout:
+                return False
+            sleep(self.RETRY_INTERVAL * 10)
+        return True
+
+    def close(self):
+        if self.shm is not None:
+            self.buffer = None
+            self.shm.close()
+        else:
+            self.buffer.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Print the contents of a RAM mirror '
+                                        'published by Beyond Backseat.')
+    parser.add_argument('--name', default='beyond_backseat',
+                        help='shared memory segment name')
+    parser.add_argument('--file', help='memory-mapped file, instead of a '
+                                       'shared memory segment')
+    parser.add_argument('--follow', action='store_true',
+                        help='print every update')
+    args = parser.parse_args()
+    reader = MirrorReader(name=args.name, filename=args.file)
+    # Start from the update before the current one, so that it is printed
+    # right away if there is one.
+    sequence = max((reader.sequence & ~1) - 2, 0)
+    try:
+        while True:
+            if not reader.wait(sequence, timeout=5):
+                print('No updates for 5 seconds.')
+                continue
+            sequence, values = reader.read()
+            print('Update {0} ({1:.3f}s old)'.format(
+                sequence // 2, time() - reader.updated))
+            for region_name, data in values.items():
+                address, _ = reader.regions[region_name]
+                print('  {0:<20} {1:0>6x} {2}'.format(
+                    region_name, address, data.hex()))
+            if not args.follow:
+                break
+    except KeyboardInterrupt:
+        pass
+    reader.close()
@@ -0,0 +1,142 @@
+from bisect import bisect_right
+from collections import deque
+from threading import Lock
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A scan reads whole regions of memory and compares them with the previous
+# scan. Each change record is (address, old bytes, new bytes) for one run of
+# changed bytes. Runs separated by MERGE_GAP unchanged bytes or fewer are
+# joined, so that a changed word or table entry is a single record.
+WRAM = [('wram', 0x7e0000, 0x20000)]
+MERGE_GAP = 4
+BLOCK_LENGTH = 64
+
+
+def find_runs(old, new, gap=MERGE_GAP):
+    # Returns the (start, end) offsets of every run of changed bytes.
+    if numpy is not None:
+        changed = numpy.flatnonzero(numpy.frombuffer(old, dtype=numpy.uint8)
+                                    != numpy.frombuffer(new,
+                                                        dtype=numpy.uint8))
+        if not len(changed):
+            return []
+        breaks = numpy.flatnonzero(numpy.diff(changed) > gap + 1)
+        starts = changed[numpy.concatenate(([0], breaks + 1))]
+        ends = changed[numpy.concatenate((breaks, [len(changed) - 1]))] + 1
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    # Without numpy, unchanged blocks are skipped with a single comparison
+    # and only the changed ones are compared byte by byte.
+    runs = []
+    for block in range(0, len(new), BLOCK_LENGTH):
+        end = min(block + BLOCK_LENGTH, len(new))
+        if old[block:end] == new[block:end]:
+            continue
+        for i in range(block, end):
+            if old[i] != new[i]:
+                if runs and i - runs[-1][1] <= gap:
+                    runs[-1][1] = i + 1
+                else:
+                    runs.append([i, i + 1])
+    return [tuple(r) for r in runs]
+
+
+def parse_regions(s):
+    # Reads regions written as "7e0000-7fffff, 7e3bf4-7e3c07".
+    regions = []
+    for region in s.split(','):
+        region = region.strip()
+        if not region:
+            continue
+        start, end = [int(a, 0x10) for a in region.split('-')]
+        regions.append((region, start, end + 1 - start))
+    return regions
+
+
+class RegionScanner():
+    def __init__(self, regions, gap=MERGE_GAP):
+        self.regions = list(regions)
+        self.gap = gap
+        self.previous = {}
+        self.watches = []
+        self.scans = 0
+
+    @property
+    def ranges(self):
+        return [(address, length) for (_, address, length) in self.regions]
+
+    def watch(self, address, length, callback):
+        # callback(old, new) is called with the watched bytes after every
+        # scan that changes any of them.
+        self.watches.append((address, length, callback))
+
+    def lookup(self, snapshots, address, length):
+        for name, start, region_length in self.regions:
+            if start <= address and address + length <= start + region_length:
+                data = snapshots.get(name)
+                if data is None:
+                    return None
+                return data[address-start:address-start+length]
+        raise KeyError('Address not scanned: {0:x}'.format(address))
+
+    def compare(self, values):
+        # values holds the data for each region, in order. Returns the change
+        # records, sorted by address. The first scan only sets the baseline.
+        old_snapshots = dict(self.previous)
+        records = []
+        for (name, address, _), data in zip(self.regions, values):
+            data = bytes(data)
+            old = self.previous.get(name)
+            self.previous[name] = data
+            if old is None:
+                continue
+            for start, end in find_runs(old, data, self.gap):
+                records.append((address + start, old[start:end],
+                                data[start:end]))
+        records.sort()
+        self.scans += 1
+        if records:
+            self.notify(records, old_snapshots)
+        return records
+
+    def notify(self, records, old_snapshots):
+        ends = [address + len(new) for (address, _, new) in records]
+        for address, length, callback in self.watches:
+            # Records do not overlap, so the first one ending past the
+            # watched address is the only candidate.
+            i = bisect_right(ends, address)
+            if i == len(records) or records[i][0] >= address + length:
+                continue
+            old = self.lookup(old_snapshots, address, length)
+            if old is not None:
+                callback(old, self.lookup(self.previous, address, length))
+
+
+class Telemetry():
+    # A ring buffer of (time, kind, data) entries. Change records are only
+    # kept while it is active, but events are always kept.
+    def __init__(self, capacity):
+        self.entries = deque(maxlen=capacity)
+        self.lock = Lock()
+        self.active = False
+
+    def record(self, kind, data=None):
+        with self.lock:
+            self.entries.append((time(), kind, data))
+
+    def record_changes(self, records):
+        if self.active and records:
+            self.record('changes', records)
+
+    def since(self, timestamp):
+        with self.lock:
+            return [e for e in self.entries if e[0] > timestamp]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,13 +1,23 @@
+import atexit
 import random
 import socket
 import traceback
+from collections import deque
+from contextlib import contextmanager
 from configparser import ConfigParser
-from datetime import datetime
-from gzip import compress, decompress
 from os import _exit, path
 from sys import argv
-from threading import Thread
-from time import sleep, time
+from multiprocessing import get_context
+from threading import Condition, Event, Lock, Thread, local
+from time import perf_counter, sleep, time
+
+import relay_protocol
+from iorecord import Recorder, REQUEST, RESPONSE, TIMEOUT
+from logwriter import LogWriter, timestamp
+from metrics import metrics, percentile
+from rammirror import RamMirror
+from ramscan import parse_regions, RegionScanner, Telemetry, WRAM
+from tracing import tracer
 
 try:
     from sys import _MEIPASS
@@ -15,19 +25,25 @@ try:
 except ImportError:
     tblpath = "tables"
 
-try:
-    config = ConfigParser()
-    if len(argv) > 1:
-        config.read(argv[1])
-    else:
-        config.read('beyond.cfg')
 
-except:
-    raise Exception('Configuration file error. ')
+def read_config(filename):
+    try:
+        config = ConfigParser()
+        config.read(filename)
+    except:
+        raise Exception('Configuration file error. ')
+    return config
+
 
+if len(argv) > 1:
+    CONFIG_FILENAME = argv[1]
+else:
+    CONFIG_FILENAME = 'beyond.cfg'
+config = read_config(CONFIG_FILENAME)
 
-UPDATE_INTERVAL = float(config['Misc']['update_interval'])
-SERIAL_NUMBER = int(config['Server']['serial_number'])
+
+STARTUP_POLL_INTERVAL = 0.1
+SIGNATURE_LENGTH = 4
 HANDLERS = {}
 
 
@@ -45,18 +61,17 @@ class Logger():
         self.unprinted = ''
 
     def set_logfile(self, filename):
-        self.logfile = open(filename, 'a+')
+        self.logfile = LogWriter(filename)
 
     def log(self, msg, debug=False):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        msg = '[{0} {1}] {2}'.format(timestamp, SERIAL_NUMBER, msg)
+        msg = '[{0} {1}] {2}'.format(timestamp(),
+                                     current_session().serial_number, msg)
         if self.print_logs or debug:
             print(msg)
         else:
             self.unprinted += msg + '\n'
         if self.logfile is not None:
             self.logfile.write(msg + '\n')
-            self.logfile.flush()
 
     def print_unprinted(self):
         s = self.unprinted.strip()
@@ -72,107 +87,844 @@ def log(msg, debug=False):
     logger.log(msg, debug=debug)
 
 
+def close_files():
+    # _exit skips atexit and the writer threads, so anything buffered is
+    # written out here first. A recording that is not closed ends in a
+    # truncated gzip member.
+    for session in list(SESSIONS):
+        if session.client.recorder is not None:
+            session.client.recorder.close()
+    if logger.logfile is not None:
+        logger.logfile.close()
+
+
+def is_wram(address):
+    return 0x7e0000 <= address < 0x800000
+
+
+def coalesce_ranges(ranges, gap=0, max_length=None):
+    merged = []
+    for address, length in sorted(ranges):
+        if merged and address <= merged[-1][0] + merged[-1][1] + gap:
+            start, old_length = merged[-1]
+            merged[-1] = (start, max(old_length, address + length - start))
+        else:
+            merged.append((address, length))
+    if max_length is None:
+        return merged
+    split = []
+    for address, length in merged:
+        for offset in range(0, length, max_length):
+            split.append((address + offset, min(max_length, length - offset)))
+    return split
+
+
+def assemble_ranges(ranges, chunks):
+    # Cuts the data for each range out of the (address, data) chunks read
+    # for coalesce_ranges.
+    results = []
+    for address, length in ranges:
+        data = [0] * length
+        for start, chunk in chunks:
+            low = max(start, address)
+            high = min(start + len(chunk), address + length)
+            if low < high:
+                data[low-address:high-address] = chunk[low-start:high-start]
+        results.append(data)
+    return results
+
+
+class CircuitBreaker():
+    FAILURE_THRESHOLD = 3
+    OPEN_INTERVAL = 0.25
+    MAX_OPEN_INTERVAL = 4
+
+    def __init__(self):
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.open_interval = self.OPEN_INTERVAL
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        # While open, every call fails fast except a single probe once the
+        # open interval has passed.
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if (self.probing or
+                    perf_counter() - self.opened_at < self.open_interval):
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log('Emulator link recovered, closing circuit breaker.',
+                    debug=True)
+            self.failures = 0
+            self.opened_at = None
+            self.open_interval = self.OPEN_INTERVAL
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.opened_at = perf_counter()
+                self.open_interval = min(self.open_interval * 2,
+                                         self.MAX_OPEN_INTERVAL)
+            elif (self.opened_at is None
+                    and self.failures >= self.FAILURE_THRESHOLD):
+                log('Emulator not responding, opening circuit breaker.',
+                    debug=True)
+                self.opened_at = perf_counter()
+                metrics.increment('emulator_breaker_opened_total')
+
+
 class ParityClient():
     NUM_RETRIES = 10
     RETRY_INTERVAL = 0.02
     MAX_LOCK_WAIT = 6
+    MAX_WRITE_LENGTH = 4
+    MAX_READ_LENGTH = 256
+    READ_GAP = 16
+    TIMEOUT = 1
 
     def __init__(self, emulator_address, emulator_port):
         self.emulator_address = emulator_address
         self.emulator_port = int(emulator_port)
         self.emulator_socket = None
+        self.recorder = None
+        self.read_cache = []
+        self.breaker = CircuitBreaker()
         self.lock = False
 
     def connect_emulator(self):
         if self.emulator_socket and self.emulator_socket.fileno() >= 0:
             self.emulator_socket.close()
         self.emulator_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.emulator_socket.settimeout(self.TIMEOUT)
         self.emulator_socket.connect((self.emulator_address,
                                       self.emulator_port))
 
+    def send_datagram(self, cmd):
+        if self.recorder is not None:
+            self.recorder.record(REQUEST, cmd)
+        self.emulator_socket.send(cmd)
+
+    def receive_datagram(self, length):
+        try:
+            data = self.emulator_socket.recv(length)
+        except socket.timeout:
+            if self.recorder is not None:
+                self.recorder.record(TIMEOUT)
+            raise
+        if self.recorder is not None:
+            self.recorder.record(RESPONSE, data)
+        return data
+
     def get_status(self):
+        with tracer.span('GET_STATUS', 'emulator') as span:
+            try:
+                cmd = 'GET_STATUS'
+                self.send_datagram(cmd.encode())
+                expected_length = 4096
+                response = self.receive_status(expected_length)
+                span['sent'] = len(cmd)
+                span['received'] = len(response)
+                status = response.decode().split()[1]
+                return status
+            except (socket.timeout, ConnectionRefusedError):
+                return 'NONRESPONSIVE'
+
+    def receive_status(self, expected_length):
+        # A read reply that came back after its request timed out is still
+        # queued on the same socket, so it is skipped here rather than taken
+        # for the status.
+        while True:
+            data = self.receive_datagram(expected_length)
+            reply = data.decode('ascii', 'replace').split()
+            if len(reply) > 1 and reply[0] == 'GET_STATUS':
+                return data
+            metrics.increment('emulator_stale_replies_total')
+
+    def drain_socket(self):
+        self.emulator_socket.setblocking(False)
+        try:
+            while True:
+                self.emulator_socket.recv(4096)
+                metrics.increment('emulator_stale_replies_total')
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        finally:
+            self.emulator_socket.settimeout(self.TIMEOUT)
+
+    def ping(self, timeout=None):
+        self.acquire_lock()
         try:
-            cmd = 'GET_STATUS'
-            self.emulator_socket.send(cmd.encode())
-            expected_length = 4096
-            response = self.emulator_socket.recv(expected_length)
-            status = response.decode().split()[1]
-            return status
-        except (socket.timeout, ConnectionRefusedError):
-            return 'NONRESPONSIVE'
+            # An old GET_STATUS reply from a ping that timed out would pass
+            # the check in receive_status, so anything still queued goes.
+            self.drain_socket()
+            if timeout is not None:
+                self.emulator_socket.settimeout(timeout)
+            start = perf_counter()
+            status = self.get_status()
+            return status, perf_counter() - start
+        finally:
+            self.emulator_socket.settimeout(self.TIMEOUT)
+            self.release_lock()
 
     def acquire_lock(self):
-        start_time = time()
-        while self.lock:
-            now = time()
-            elapsed = now - start_time
-            if self.MAX_LOCK_WAIT > 0 and elapsed > self.MAX_LOCK_WAIT:
-                break
-            sleep(self.RETRY_INTERVAL)
-        self.lock = True
+        with tracer.span('acquire_lock', 'lock') as span:
+            start_time = time()
+            while self.lock:
+                now = time()
+                elapsed = now - start_time
+                if self.MAX_LOCK_WAIT > 0 and elapsed > self.MAX_LOCK_WAIT:
+                    span['timeout'] = True
+                    metrics.increment('client_lock_timeouts_total')
+                    break
+                sleep(self.RETRY_INTERVAL)
+            self.lock = True
+            metrics.observe('client_lock_wait_seconds', time() - start_time)
 
     def release_lock(self):
         self.lock = False
 
-    def send_emulator(self, address, data):
-        if len(data) == 0:
-            log('Warning: Zero-length write at {0:x}.'.format(address))
-            return
-        self.acquire_lock()
-        MAX_WRITE_LENGTH = 4
+    def send_chunks(self, address, data):
+        sent, datagrams = 0, 0
         while data:
-            subdata, data = data[:MAX_WRITE_LENGTH], data[MAX_WRITE_LENGTH:]
-            assert len(subdata) <= MAX_WRITE_LENGTH
+            subdata, data = (data[:self.MAX_WRITE_LENGTH],
+                             data[self.MAX_WRITE_LENGTH:])
             s = ' '.join(['{0:0>2X}'.format(d) for d in subdata])
             cmd = 'WRITE_CORE_RAM {0:0>6x} {1}'.format(address, s)
             cmd = cmd.encode()
-            self.emulator_socket.send(cmd)
+            self.send_datagram(cmd)
             address += len(subdata)
-        self.release_lock()
+            sent += len(cmd)
+            datagrams += 1
+        return sent, datagrams
+
+    def send_emulator(self, address, data):
+        if len(data) == 0:
+            log('Warning: Zero-length write at {0:x}.'.format(address))
+            return
+        self.send_emulator_batch([(address, data)])
+
+    def send_emulator_batch(self, writes):
+        # Writes are sent in the order given, so a later write to the same
+        # address wins. Each one that continues the previous is joined to
+        # it, and the whole set is sent under one acquisition of the lock.
+        writes = [(address, list(data)) for (address, data) in writes
+                  if len(data)]
+        if not writes:
+            return
+        spans = []
+        for address, data in writes:
+            if spans and address == spans[-1][0] + len(spans[-1][1]):
+                spans[-1][1].extend(data)
+            else:
+                spans.append((address, list(data)))
+        num_bytes = sum(len(data) for (_, data) in spans)
+        with tracer.span('WRITE_CORE_RAM', 'emulator', address=spans[0][0],
+                         num_bytes=num_bytes, runs=len(writes)) as span:
+            self.acquire_lock()
+            sent, datagrams = 0, 0
+            try:
+                for address, data in spans:
+                    self.update_cache(address, data)
+                    span_sent, span_datagrams = self.send_chunks(address,
+                                                                 data)
+                    sent += span_sent
+                    datagrams += span_datagrams
+            finally:
+                self.release_lock()
+            span['sent'] = sent
+            span['datagrams'] = datagrams
+            metrics.increment('emulator_writes_total')
+            metrics.increment('emulator_written_bytes_total', num_bytes)
+            metrics.increment('emulator_datagrams_total', datagrams,
+                              direction='sent')
+
+    def prefetch(self, ranges):
+        # Reads every range in as few requests as possible, so that later
+        # reads inside them are answered without a round trip.
+        cache = []
+        for address, length in coalesce_ranges(ranges, self.READ_GAP,
+                                               self.MAX_READ_LENGTH):
+            cache.append((address, self.read_emulator(address, length)))
+        self.read_cache = cache
+        return len(cache)
+
+    def clear_cache(self):
+        self.read_cache = []
+
+    def read_ranges(self, ranges):
+        # Reads every range with as few requests as possible, and returns
+        # the data for each range in order.
+        chunks = [(address, self.read_emulator(address, length))
+                  for (address, length) in coalesce_ranges(
+                      ranges, self.READ_GAP, self.MAX_READ_LENGTH)]
+        return assemble_ranges(ranges, chunks)
+
+    def read_cached(self, address, num_bytes):
+        for start, data in self.read_cache:
+            if start <= address and address + num_bytes <= start + len(data):
+                return data[address-start:address-start+num_bytes]
+        return None
+
+    def update_cache(self, address, data):
+        for start, cached in self.read_cache:
+            low = max(start, address)
+            high = min(start + len(cached), address + len(data))
+            if low < high:
+                cached[low-start:high-start] = data[low-address:high-address]
 
     def read_emulator(self, address, num_bytes):
+        cached = self.read_cached(address, num_bytes)
+        if cached is not None:
+            metrics.increment('emulator_cached_reads_total')
+            return cached
+        with tracer.span('READ_CORE_RAM', 'emulator', address=address,
+                         num_bytes=num_bytes) as span:
+            return self._read_emulator(address, num_bytes, span)
+
+    def receive_read(self, address, expected_length):
+        # Replies that arrive after their request timed out are skipped, so
+        # that they are not taken for the answer to a later read.
+        while True:
+            data = self.receive_datagram(expected_length)
+            reply = data.decode('ascii').strip().split(' ')
+            if (len(reply) > 1 and reply[0] == 'READ_CORE_RAM'
+                    and int(reply[1], 0x10) == address):
+                return data, reply[2:]
+            metrics.increment('emulator_stale_replies_total')
+
+    def backoff(self, attempt):
+        sleep(random.uniform(0, self.RETRY_INTERVAL * (1.5**attempt)))
+
+    def _read_emulator(self, address, num_bytes, span):
+        # The lock is only held for each exchange, so other jobs can use the
+        # link while this read waits to retry.
         cmd = 'READ_CORE_RAM {0:0>6x} {1}'.format(address, num_bytes)
-        self.acquire_lock()
+        expected_length = 21 + (3 * num_bytes)
+        sent, received = 0, 0
+        data, error = [], None
         for i in range(self.NUM_RETRIES):
-            self.emulator_socket.send(cmd.encode())
-            expected_length = 21 + (3 * num_bytes)
+            if not self.breaker.allow():
+                metrics.increment('emulator_breaker_rejections_total')
+                raise IOError('Emulator not responding.')
+            self.acquire_lock()
             try:
-                data = self.emulator_socket.recv(expected_length)
-            except socket.timeout:
+                self.send_datagram(cmd.encode())
+                sent += len(cmd)
+                response, data = self.receive_read(address, expected_length)
+            except (socket.timeout, ConnectionRefusedError):
+                response, error = None, 'Emulator not responding.'
+            except Exception:
+                # Anything else still ends a probe, so that the breaker
+                # does not wait on it forever.
+                self.breaker.record_failure()
+                raise
+            finally:
                 self.release_lock()
-                raise IOError('Emulator not responding.')
-            data = data.decode('ascii').strip()
-            data = [int(d, 0x10) for d in data.split(' ')[2:]]
+            span['sent'], span['attempts'] = sent, i + 1
+            if response is None:
+                self.breaker.record_failure()
+                metrics.increment('emulator_read_timeouts_total')
+                self.backoff(i)
+                continue
+            self.breaker.record_success()
+            received += len(response)
+            span['received'] = received
+            data = [int(d, 0x10) for d in data]
             if len(data) == num_bytes and -1 not in data:
                 break
-            log('Warning: Emulator read error: {0:x} {1}/{2} bytes'.format(
-                address, len(data), num_bytes))
-            sleep(self.RETRY_INTERVAL * (1.5**i))
+            error = 'Emulator read error: {0:x} {1}/{2} bytes'.format(
+                address, len(data), num_bytes)
+            log('Warning: ' + error)
+            metrics.increment('emulator_read_retries_total')
+            self.backoff(i)
         else:
-            self.release_lock()
-            raise IOError('Emulator read error: {0:x} {1}/{2} bytes'.format(
-                address, len(data), num_bytes))
-        self.release_lock()
+            metrics.increment('emulator_read_errors_total')
+            raise IOError(error)
+        metrics.increment('emulator_reads_total')
+        metrics.increment('emulator_read_bytes_total', num_bytes)
+        metrics.increment('emulator_datagrams_total', i + 1, direction='sent')
+        metrics.increment('emulator_datagrams_total', i + 1,
+                          direction='received')
         return data
 
     def show_message(self, msg):
         if ('show_messages' in config['Emulator'] and
                 config['Emulator']['show_messages'][:1].lower() == 'y'):
             cmd = 'SHOW_MSG {0}'.format(msg)
-            self.emulator_socket.send(cmd.encode())
+            self.send_datagram(cmd.encode())
+
 
+class Supervisor():
+    HEARTBEAT_INTERVAL = 1
+    MAX_HEARTBEAT_LATENCY = 0.5
+    MAX_MISSED_HEARTBEATS = 2
+    MIN_BACKOFF = 0.05
+    MAX_BACKOFF = 5
+    LIVE_STATUSES = ['PLAYING', 'PAUSED']
 
-client = ParityClient(config['Emulator']['address'],
-                      config['Emulator']['port'])
+    def __init__(self, client):
+        self.client = client
+        self.link_up = Event()
+        self.link_up.set()
+        self.condition = Condition()
+        self.busy = 0
+        self.wakeup = Event()
+        self.missed = 0
+        self.latency = None
+        self.interrupted = []
+
+    def heartbeat(self):
+        status, self.latency = self.client.ping(self.MAX_HEARTBEAT_LATENCY)
+        metrics.observe('emulator_heartbeat_seconds', self.latency)
+        if (status in self.LIVE_STATUSES
+                and self.latency <= self.MAX_HEARTBEAT_LATENCY):
+            self.missed = 0
+            self.client.breaker.record_success()
+            return True
+        self.missed += 1
+        metrics.increment('emulator_heartbeats_missed_total')
+        log('Emulator heartbeat missed: {0} after {1:.3f}s'.format(
+            status, self.latency), debug=True)
+        return False
+
+    def interrupt(self, job=None):
+        # Called by the job thread when the link fails under it. Jobs wait
+        # until the link has been checked, and the job that was cut off
+        # partway through is reset if it was mid-handshake.
+        self.link_up.clear()
+        if job is not None and job not in self.interrupted:
+            self.interrupted.append(job)
+        self.wakeup.set()
+
+    @contextmanager
+    def working(self):
+        # Threads hold this while they use the client. It waits for the
+        # link, and the supervisor only reconnects or probes once every
+        # thread has let go.
+        with self.condition:
+            self.condition.wait_for(self.link_up.is_set)
+            self.busy += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.busy -= 1
+                self.condition.notify_all()
+
+    def park(self):
+        with self.condition:
+            self.link_up.clear()
+            self.condition.wait_for(lambda: self.busy == 0)
+
+    def resume(self):
+        with self.condition:
+            self.link_up.set()
+            self.condition.notify_all()
+
+    def reconnect(self):
+        start = perf_counter()
+        attempt = 0
+        while True:
+            self.client.connect_emulator()
+            status, _ = self.client.ping(self.MAX_HEARTBEAT_LATENCY)
+            if status in self.LIVE_STATUSES:
+                self.client.breaker.record_success()
+                break
+            backoff = min(self.MAX_BACKOFF, self.MIN_BACKOFF * (2**attempt))
+            sleep(random.uniform(backoff / 2, backoff))
+            attempt += 1
+        outage = perf_counter() - start
+        log('Reconnected to emulator after {0:.3f}s.'.format(outage))
+        metrics.increment('emulator_reconnects_total')
+        metrics.observe('emulator_outage_seconds', outage)
+
+    def recover(self):
+        # The job queue, parsed patches and backups are kept. The probe
+        # reapplies hooks and resets handshakes if the game was reset in
+        # the meantime; other jobs resume from the lock byte.
+        self.client.clear_cache()
+        if INSTALLED_PATCHES or PROBE_HANDLERS:
+            probe_integrity()
+        for j in list(self.interrupted):
+            if (hasattr(j, 'state') and j.state.get('event')
+                    and not j.finished):
+                log('Resetting interrupted job: %s' % j)
+                j.reset()
+            self.interrupted.remove(j)
+        self.missed = 0
+        self.resume()
+
+    def check(self):
+        healthy = self.heartbeat()
+        if healthy and self.link_up.is_set():
+            return
+        if not (healthy or self.interrupted
+                or self.missed >= self.MAX_MISSED_HEARTBEATS):
+            return
+        self.park()
+        if not healthy:
+            self.reconnect()
+        self.recover()
+
+    def watch(self):
+        # A missed heartbeat is followed up right away.
+        if self.missed:
+            self.wakeup.wait(self.MIN_BACKOFF)
+        else:
+            self.wakeup.wait(self.HEARTBEAT_INTERVAL)
+        self.wakeup.clear()
+        self.check()
 
 
-class LivePatch():
-    GLOBAL_DEFINITIONS = {}
+class Session():
+    # Everything that belongs to one emulator. Module-level names such as
+    # client, config and JOBS refer to the session active on the current
+    # thread, which is the default session unless another was activated.
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.serial_number = int(config['Server']['serial_number'])
+        self.client = ParityClient(config['Emulator']['address'],
+                                   config['Emulator']['port'])
+        self.supervisor = Supervisor(self.client)
+        self.jobs = []
+        self.installed_patches = []
+        self.probe_handlers = []
+        self.mirror_regions = []
+        self.mirror = None
+        self.scan_watches = []
+        self.scanner = None
+        self.scan_pending = []
+        self.scan_chunks = []
+        self.telemetry = None
+        self.startup_timings = {}
+        self.playing_at = None
+        self.tables = {}
+        self.currents = {}
+        self.global_definitions = {}
+        self.read_settings()
+
+    def __repr__(self):
+        return 'Session({0})'.format(self.name)
+
+    def read_settings(self):
+        # Timing settings come from each session's own configuration.
+        misc = self.config['Misc']
+        self.update_interval = float(misc['update_interval'])
+        self.integrity_interval = 0
+        if 'integrity_interval' in misc:
+            self.integrity_interval = float(misc['integrity_interval'])
+        self.mirror_interval = self.update_interval
+        if 'mirror_interval' in misc:
+            self.mirror_interval = float(misc['mirror_interval'])
+        self.scan_interval = 0
+        if 'scan_interval' in misc:
+            self.scan_interval = float(misc['scan_interval'])
+        self.scan_reads = 16
+        if 'scan_reads' in misc:
+            self.scan_reads = int(misc['scan_reads'])
+
+    def activate(self):
+        ACTIVE.session = self
+
+    def run(self, function, *args):
+        self.activate()
+        return function(*args)
+
+
+class SessionAttribute():
+    # Stands in for a module-level name and forwards to that attribute of
+    # the active session.
+    def __init__(self, attribute):
+        object.__setattr__(self, 'attribute', attribute)
+
+    @property
+    def target(self):
+        return getattr(current_session(), self.attribute)
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.target, name, value)
+
+    def __getitem__(self, key):
+        return self.target[key]
+
+    def __setitem__(self, key, value):
+        self.target[key] = value
+
+    def __delitem__(self, key):
+        del self.target[key]
+
+    def __contains__(self, key):
+        return key in self.target
+
+    def __iter__(self):
+        return iter(self.target)
 
-    def __init__(self, name, patch_filename, force_valid=False):
+    def __len__(self):
+        return len(self.target)
+
+    def __bool__(self):
+        return bool(self.target)
+
+    def __repr__(self):
+        return repr(self.target)
+
+
+def current_session():
+    return getattr(ACTIVE, 'session', default_session)
+
+
+def run_session_process(name, config_filename, function, index):
+    # A forked process has no log writer thread, so the log is reopened,
+    # under the session's name so that processes do not rotate one file.
+    # Each process also serves metrics on its own port.
+    if logger.logfile is not None:
+        base, extension = path.splitext(logger.logfile.filename)
+        logger.set_logfile('{0}.{1}{2}'.format(base, name, extension))
+    session = Session(name, read_config(config_filename))
+    if ('metrics_port' in session.config['Misc']
+            and session.config['Misc']['metrics_port']):
+        session.config['Misc']['metrics_port'] = str(
+            int(session.config['Misc']['metrics_port']) + index)
+    session.run(function)
+
+
+def run_sessions(config_filenames, function, pool='thread'):
+    # Runs function, normally a main loop, once for each configuration.
+    # With a thread pool the sessions share parsed patches and tables; with
+    # a process pool each session gets its own interpreter.
+    names = [path.splitext(path.basename(f))[0] for f in config_filenames]
+    if pool == 'process':
+        context = get_context()
+        workers = [context.Process(target=run_session_process,
+                                   args=(name, filename, function, i),
+                                   daemon=True)
+                   for (i, (name, filename)) in enumerate(
+                       zip(names, config_filenames))]
+    else:
+        sessions = []
+        for name, filename in zip(names, config_filenames):
+            if filename == CONFIG_FILENAME:
+                default_session.name = name
+                sessions.append(default_session)
+            else:
+                sessions.append(Session(name, read_config(filename)))
+        workers = [Thread(target=session.run, args=(function,), daemon=True)
+                   for session in sessions]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            sleep(1)
+    except(KeyboardInterrupt):
+        if pool == 'process':
+            # The workers get the interrupt too; give them a moment to close
+            # their own files.
+            for worker in workers:
+                worker.join(1)
+                worker.terminate()
+        close_files()
+        _exit(0)
+
+
+ACTIVE = local()
+SESSIONS = []
+default_session = Session('default', config)
+config = SessionAttribute('config')
+client = SessionAttribute('client')
+supervisor = SessionAttribute('supervisor')
+JOBS = SessionAttribute('jobs')
+INSTALLED_PATCHES = SessionAttribute('installed_patches')
+PROBE_HANDLERS = SessionAttribute('probe_handlers')
+MIRROR_REGIONS = SessionAttribute('mirror_regions')
+SCAN_WATCHES = SessionAttribute('scan_watches')
+GLOBAL_DEFINITIONS = SessionAttribute('global_definitions')
+STARTUP_TIMINGS = SessionAttribute('startup_timings')
+
+
+class WriteTransaction():
+    # Stages writes so that they go out together. Triggers, such as the lock
+    # byte that tells the game to go ahead, are sent last and only once the
+    # other writes are confirmed in RAM. Everything overwritten is backed up
+    # first, so that a failure can be rolled back. Writes that nothing
+    # triggers are simply sent.
+    VERIFY_ATTEMPTS = 4
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+        self.triggers = []
+        self.bit_triggers = []
+        self.bits = {}
+        self.expected = []
+        self.backup = {}
+        self.confirmed = set([])
+        self.sent = []
+
+    def write(self, address, data, previous=None, confirm=False):
+        # WRAM is only checked with confirm, for memory the game leaves
+        # alone until the trigger.
+        self.writes.append((address, list(data)))
+        if previous is not None:
+            self.backup[address] = list(previous)
+        if confirm:
+            self.confirmed.add(address)
+
+    def write_patch(self, patch, data=None, force=False):
+        # Unapplied patch code replaces what the patch has backed up, so
+        # those bytes do not need to be read again. WRAM may have changed
+        # since, so it is always read.
+        if data is None:
+            patch.check_approved_addresses()
+            data = patch.patch
+        for address, code in patch.get_writes(data, force=force):
+            previous = None
+            if (data is patch.patch and not patch.applied_patch
+                    and not is_wram(address)
+                    and len(patch.backup.get(address, [])) == len(code)):
+                previous = patch.backup[address]
+            self.write(address, code, previous=previous)
+
+    def trigger(self, address, data, previous=None):
+        self.triggers.append((address, list(data)))
+        if previous is not None:
+            self.backup[address] = list(previous)
+
+    def trigger_bits(self, address, set_bits=0, unset_bits=0):
+        # A byte shared with the game or other jobs, such as a lock byte, is
+        # read again right before the triggers go out, and only these bits
+        # are changed. bits then holds its (old, new) values.
+        self.bit_triggers.append((address, set_bits, unset_bits))
+
+    def expect(self, address, data):
+        # Memory the triggers depend on, such as a flag the game may clear
+        # at any time. It is read again right before the triggers go out,
+        # and the transaction is rolled back if it changed.
+        self.expected.append((address, list(data)))
+
+    def check_expected(self):
+        ranges = [(address, len(data)) for (address, data) in self.expected]
+        return all(result == data for ((_, data), result) in zip(
+            self.expected, self.client.read_ranges(ranges)))
+
+    def read_bit_triggers(self):
+        triggers = []
+        for address, set_bits, unset_bits in self.bit_triggers:
+            value = self.client.read_emulator(address, 1)[0]
+            new_value = (value | set_bits | unset_bits) ^ unset_bits
+            self.bits[address] = (value, new_value)
+            if new_value != value:
+                self.backup[address] = [value]
+                triggers.append((address, [new_value]))
+        return triggers
+
+    def snapshot(self):
+        ranges = [(address, len(data))
+                  for (address, data) in self.writes + self.triggers
+                  if address not in self.backup]
+        for (address, _), data in zip(ranges, self.client.read_ranges(ranges)):
+            self.backup[address] = data
+
+    def unconfirmed(self):
+        # The game may change WRAM at any time, so only code is checked.
+        writes = [(address, data) for (address, data) in self.writes
+                  if not is_wram(address) or address in self.confirmed]
+        ranges = [(address, len(data)) for (address, data) in writes]
+        return [(address, data) for ((address, data), result)
+                in zip(writes, self.client.read_ranges(ranges))
+                if result != data]
+
+    def commit(self, verify=True):
+        # Returns False if the expected memory changed and nothing was
+        # triggered.
+        if not (self.triggers or self.bit_triggers):
+            self.client.send_emulator_batch(self.writes)
+            metrics.increment('transactions_total')
+            return True
+        with tracer.span('commit', 'emulator', writes=len(self.writes),
+                         triggers=len(self.triggers)) as span:
+            self.snapshot()
+            try:
+                self.send(self.writes)
+                if verify:
+                    # Writes get no reply, so a lost or late one only shows
+                    # up when reading it back. It is sent again.
+                    for i in range(self.VERIFY_ATTEMPTS + 1):
+                        unconfirmed = self.unconfirmed()
+                        if not unconfirmed:
+                            break
+                        if i == self.VERIFY_ATTEMPTS:
+                            raise IOError('Write verification failed.')
+                        span['resent'] = i + 1
+                        metrics.increment('transaction_resends_total')
+                        sleep(self.client.RETRY_INTERVAL * (2**i))
+                        self.client.send_emulator_batch(unconfirmed)
+                if self.expected and not self.check_expected():
+                    span['aborted'] = True
+                    self.rollback()
+                    return False
+                self.send(self.triggers + self.read_bit_triggers())
+            except Exception:
+                self.rollback()
+                raise
+        metrics.increment('transactions_total')
+        return True
+
+    def send(self, batch):
+        # A batch counts as sent before it goes out, since a failure partway
+        # through may still have written some of it.
+        if batch:
+            self.sent.append(batch)
+            self.client.send_emulator_batch(batch)
+
+    def rollback(self):
+        # Only what was sent is restored, most recent first, so that a
+        # failed verification does not write over triggers it never sent.
+        if not self.sent:
+            return
+        log('Rolling back {0} writes.'.format(
+            sum(len(batch) for batch in self.sent)))
+        metrics.increment('transaction_rollbacks_total')
+        try:
+            for batch in reversed(self.sent):
+                self.client.send_emulator_batch(
+                    [(address, self.backup[address])
+                     for (address, _) in batch])
+        except OSError:
+            log(traceback.format_exc(), debug=True)
+
+
+class LivePatch():
+    # Global definitions, such as the free space bank, belong to the
+    # session. Parsed patches are shared, keyed by those definitions.
+    GLOBAL_DEFINITIONS = GLOBAL_DEFINITIONS
+    PARSED = {}
+
+    def __init__(self, name, patch_filename, force_valid=False, load=True,
+                 global_definitions=None):
+        if global_definitions is None:
+            global_definitions = current_session().global_definitions
+        self.global_definitions = dict(global_definitions)
         self.client = client
         self.patch_filename = patch_filename
-        patch_filepath = path.join(tblpath, patch_filename)
         self.master = []
         self.patch = {}
         self.backup = {}
@@ -182,10 +934,34 @@ class LivePatch():
         self.name = name
         self.approved_addresses = set([])
         self.applied_patch = False
-
-        validation_flag = False
         self.lenalpha = lambda s: (-len(s), s)
 
+        # Patch files are only read and parsed once for each set of global
+        # definitions; every later instance starts from a copy.
+        key = (patch_filename, tuple(sorted(self.global_definitions.items())))
+        if key not in self.PARSED:
+            self.parse(path.join(tblpath, patch_filename))
+            self.PARSED[key] = (self.copy_master(), dict(self.definitions))
+        master, definitions = self.PARSED[key]
+        self.master = self.copy_master(master)
+        self.definitions = dict(definitions)
+
+        self.generate_patch_from_master(backup=load)
+        if load:
+            self.validate(force_valid=force_valid)
+
+    def __repr__(self):
+        return self.name
+
+    def copy_master(self, master=None):
+        if master is None:
+            master = self.master
+        return [line if line == 'VALIDATION' else
+                (line[0], list(line[1]) if isinstance(line[1], list)
+                 else line[1]) for line in master]
+
+    def parse(self, patch_filepath):
+        validation_flag = False
         f = open(patch_filepath)
         for line in f.readlines():
             if '#' in line:
@@ -196,10 +972,10 @@ class LivePatch():
             if not line:
                 continue
 
-            for definition in sorted(self.GLOBAL_DEFINITIONS,
+            for definition in sorted(self.global_definitions,
                                      key=self.lenalpha):
                 line = line.replace(definition,
-                                    self.GLOBAL_DEFINITIONS[definition])
+                                    self.global_definitions[definition])
 
             if line == 'VALIDATION':
                 self.master.append(line)
@@ -248,12 +1024,6 @@ class LivePatch():
 
         f.close()
 
-        self.generate_patch_from_master()
-        self.validate(force_valid=force_valid)
-
-    def __repr__(self):
-        return self.name
-
     def verify_nonhex(self, s):
         return any([c for c in s if c.lower() not in '0123456789abcdef'])
 
@@ -264,7 +1034,37 @@ class LivePatch():
                     'Error: Discovered unapproved address '
                     '{0:x} in patch {1}'.format(key, self.patch_filename))
 
-    def generate_patch_from_master(self):
+    def load(self, force_valid=False):
+        self.make_backup()
+        self.validate(force_valid=force_valid)
+
+    @property
+    def signatures(self):
+        # The patched bytes at each point where validation expects the
+        # original code. Semaphores in WRAM are checked separately.
+        signatures = []
+        for address, original in sorted(self.validation.items()):
+            if is_wram(address) or address not in self.patch:
+                continue
+            code = self.patch[address][:SIGNATURE_LENGTH]
+            if code != original[:len(code)]:
+                signatures.append((address, code))
+        return signatures
+
+    def check_signatures(self):
+        return all(self.client.read_emulator(address, len(code)) == code
+                   for (address, code) in self.signatures)
+
+    def invalidate(self):
+        if not self.applied_patch:
+            self.make_backup()
+
+    @property
+    def read_ranges(self):
+        return [(address, len(code)) for (address, code)
+                in list(self.patch.items()) + list(self.validation.items())]
+
+    def generate_patch_from_master(self, backup=True):
         self.check_approved_addresses()  # check here to avoid dropping addrs
         validation_flag = False
         self.labels = {}
@@ -318,7 +1118,8 @@ class LivePatch():
             if not all([0 <= c <= 0xff for c in code]):
                 raise Exception('Syntax error: %s' % self.patch_filename)
 
-        self.make_backup()
+        if backup:
+            self.make_backup()
 
     def validate(self, force_valid=False):
         for address, code in sorted(self.validation.items()):
@@ -333,61 +1134,267 @@ class LivePatch():
                                     % self.patch_filename)
 
     def make_backup(self):
-        for address, code in sorted(self.patch.items()):
-            result = self.client.read_emulator(address, len(code))
-            self.backup[address] = result
+        with tracer.span('make_backup', 'patch', patch=self.name):
+            ranges = [(address, len(code))
+                      for (address, code) in sorted(self.patch.items())]
+            for (address, _), result in zip(
+                    ranges, self.client.read_ranges(ranges)):
+                self.backup[address] = result
 
     def set_label(self, label, new_data, change_length=False):
-        if isinstance(new_data, int):
-            new_data = [new_data]
-
-        address = self.labels[label]
-        old_data = self.patch[address]
-        if isinstance(old_data, int):
-            old_data = [old_data]
-
-        index = self.master.index(('.label', label))
-        master_addr, to_replace = self.master[index+1]
-        assert to_replace == old_data
-        self.master[index+1] = (master_addr, new_data)
-        assert self.patch[self.labels[label]] == old_data
-        self.generate_patch_from_master()
-        if len(new_data) > 0:
-            assert self.patch[self.labels[label]] == new_data
-
-        if not change_length:
-            assert len(old_data) == len(new_data)
-            assert address == self.labels[label]
+        with tracer.span('set_label', 'patch', patch=self.name, label=label):
+            if isinstance(new_data, int):
+                new_data = [new_data]
+
+            address = self.labels[label]
+            old_data = self.patch[address]
+            if isinstance(old_data, int):
+                old_data = [old_data]
+
+            index = self.master.index(('.label', label))
+            master_addr, to_replace = self.master[index+1]
+            assert to_replace == old_data
+            self.master[index+1] = (master_addr, new_data)
+            assert self.patch[self.labels[label]] == old_data
+            # The backup only has to be read again if the code moved.
+            layout = [(a, len(c)) for (a, c) in sorted(self.patch.items())]
+            self.generate_patch_from_master(backup=False)
+            if layout != [(a, len(c)) for (a, c)
+                          in sorted(self.patch.items())]:
+                self.make_backup()
+            if len(new_data) > 0:
+                assert self.patch[self.labels[label]] == new_data
+
+            if not change_length:
+                assert len(old_data) == len(new_data)
+                assert address == self.labels[label]
 
     def restore_backup(self):
-        self.write(self.backup, force=True)
+        with tracer.span('restore_backup', 'patch', patch=self.name):
+            self.write(self.backup, force=True)
 
     def apply_patch(self):
-        self.check_approved_addresses()
-        self.write(self.patch)
-        self.applied_patch = True
+        with tracer.span('apply_patch', 'patch', patch=self.name):
+            self.check_approved_addresses()
+            self.write(self.patch)
+            self.applied_patch = True
 
     def write(self, data, force=False):
+        transaction = WriteTransaction(self.client)
+        transaction.write_patch(self, data, force=force)
+        transaction.commit()
+
+    def get_writes(self, data, force=False):
+        # Conflicts are found before anything is sent.
         written_zones = []
+        writes = []
         for address, code in sorted(data.items()):
             for low, high in written_zones:
                 if low <= address < high and not force:
-                    self.restore_backup()
                     raise Exception('Write conflict in %s patch. %x %x %x' % (self.name, low, address, high))
             if isinstance(code, int):
                 code = [code]
-            self.client.send_emulator(address, code)
+            writes.append((address, code))
             written_zones.append((address, address + len(code)))
+        return writes
+
+
+def apply_patches(patch_filenames):
+    # Parses every patch first, reads everything they need to back up and
+    # validate in one batched plan, then applies them all as one write set.
+    timings = {}
+    start = perf_counter()
+    patches = [LivePatch(None, f, load=False) for f in patch_filenames]
+    timings['parse'] = perf_counter() - start
+
+    start = perf_counter()
+    ranges = [r for p in patches for r in p.read_ranges]
+    num_reads = client.prefetch(ranges)
+    try:
+        for p in patches:
+            p.load()
+    finally:
+        client.clear_cache()
+    timings['read'] = perf_counter() - start
+
+    start = perf_counter()
+    writes = []
+    written = {}
+    for p in patches:
+        p.check_approved_addresses()
+        for address, code in p.get_writes(p.patch):
+            # Every backup was read before anything was applied, so patches
+            # may only overlap where they write the same bytes.
+            for i, c in enumerate(code):
+                if written.setdefault(address + i, c) != c:
+                    raise Exception('Write conflict between patches at '
+                                    '{0:x} in {1}.'.format(address + i,
+                                                           p.patch_filename))
+            writes.append((address, code))
+        p.applied_patch = True
+    client.send_emulator_batch(writes)
+    INSTALLED_PATCHES.extend(patches)
+    timings['write'] = perf_counter() - start
+    STARTUP_TIMINGS.update(timings)
+    log('Applied {0} patches: {1} reads, {2} writes; {3}'.format(
+        len(patches), num_reads, len(writes), format_timings(timings)))
+    return patches
+
+
+def probe_integrity():
+    # A savestate or reset can undo installed hooks. Only the patches with
+    # missing hooks are written again, as one batch.
+    with tracer.span('probe_integrity', 'patch') as span:
+        ranges = [(address, len(code)) for p in INSTALLED_PATCHES
+                  for (address, code) in p.signatures]
+        client.prefetch(ranges)
+        try:
+            missing = [p for p in INSTALLED_PATCHES
+                       if not p.check_signatures()]
+        finally:
+            client.clear_cache()
+        # A patch that overwrites part of a missing one, such as a hook
+        # chained onto its code, is written again after it.
+        zones = [(address, address + len(code)) for p in missing
+                 for (address, code) in p.patch.items()
+                 if not is_wram(address)]
+        missing = [p for p in INSTALLED_PATCHES if p in missing or any(
+            low < address + len(code) and address < high
+            for (address, code) in p.patch.items() if not is_wram(address)
+            for (low, high) in zones)]
+        metrics.increment('integrity_probes_total')
+        span['missing'] = len(missing)
+        writes = []
+        for p in missing:
+            writes.extend(p.get_writes({
+                address: code for (address, code) in p.patch.items()
+                if not is_wram(address)}))
+        # Handlers may return WRAM writes that the missing hooks depend on,
+        # to go out in the same batch as the code.
+        for handler in PROBE_HANDLERS:
+            writes.extend(handler(reset=bool(missing), missing=missing) or [])
+        if writes:
+            client.send_emulator_batch(writes)
+        if missing:
+            log('Hooks missing, reapplied: %s' % ', '.join(
+                p.patch_filename for p in missing))
+            metrics.increment('patches_reapplied_total', len(missing))
+            for j in list(JOBS):
+                j.invalidate()
+    return missing
+
+
+def open_mirror():
+    # Publishes the tables and any registered regions for other processes,
+    # so that they can follow the game without talking to the emulator.
+    session = current_session()
+    regions = []
+    tables_list = TableObject.read_tables_list()
+    for class_name, (specs_filename, address, number) in sorted(
+            tables_list.items(), key=lambda item: item[1][1]):
+        specs = TableObject.read_specs(specs_filename)
+        full_length = sum([length for _, length, _ in specs])
+        regions.append((class_name, address, full_length * number))
+    regions.extend(MIRROR_REGIONS)
+    name, filename = 'beyond_backseat', None
+    if 'mirror_name' in config['Misc'] and config['Misc']['mirror_name']:
+        name = config['Misc']['mirror_name']
+    if 'mirror_file' in config['Misc'] and config['Misc']['mirror_file']:
+        filename = config['Misc']['mirror_file']
+    session.mirror = RamMirror(regions, name=name, filename=filename)
+    atexit.register(session.mirror.close)
+    log('Publishing {0} RAM regions ({1} bytes) to {2}.'.format(
+        len(regions), session.mirror.size, filename or name), debug=True)
+
+
+def publish_mirror():
+    mirror = current_session().mirror
+    with tracer.span('publish_mirror', 'mirror'):
+        mirror.update(client.read_ranges(mirror.ranges))
+    metrics.increment('mirror_updates_total')
+
+
+def open_scanner():
+    # Scans whole regions of memory for changes, and calls the registered
+    # watches with the old and new bytes of anything they cover.
+    session = current_session()
+    if 'scan_regions' in config['Misc'] and config['Misc']['scan_regions']:
+        regions = parse_regions(config['Misc']['scan_regions'])
+    else:
+        regions = WRAM
+    session.scanner = RegionScanner(regions)
+    for address, length, callback in SCAN_WATCHES:
+        session.scanner.watch(address, length, callback)
+    if ('telemetry_length' in config['Misc']
+            and config['Misc']['telemetry_length']):
+        session.telemetry = Telemetry(int(config['Misc']['telemetry_length']))
+    reads = len(coalesce_ranges(session.scanner.ranges, client.READ_GAP,
+                                client.MAX_READ_LENGTH))
+    log('Scanning {0} bytes of RAM every {1}s, {2} reads at a time out of '
+        '{3}.'.format(sum(length for (_, _, length) in regions),
+                      session.scan_interval, session.scan_reads, reads),
+        debug=True)
+
+
+def scan_memory():
+    # Each call reads the next scan_reads chunks of a scan, so that the job
+    # loop is never held up for a whole scan. Returns None until the last
+    # chunk is read, then the change records.
+    session = current_session()
+    scanner = session.scanner
+    if not session.scan_pending:
+        session.scan_pending = coalesce_ranges(
+            scanner.ranges, client.READ_GAP, client.MAX_READ_LENGTH)
+        session.scan_chunks = []
+    batch = session.scan_pending[:session.scan_reads]
+    del session.scan_pending[:session.scan_reads]
+    try:
+        with tracer.span('scan_reads', 'scan', reads=len(batch)):
+            session.scan_chunks.extend(
+                (address, client.read_emulator(address, length))
+                for (address, length) in batch)
+    except OSError:
+        # A scan that loses the link starts over, rather than comparing
+        # data from either side of the failure.
+        session.scan_pending = []
+        raise
+    if session.scan_pending:
+        return None
+
+    with tracer.span('scan_memory', 'scan') as span:
+        records = scanner.compare(
+            assemble_ranges(scanner.ranges, session.scan_chunks))
+        span['changes'] = len(records)
+    session.scan_chunks = []
+    if session.telemetry is not None:
+        session.telemetry.record_changes(records)
+    metrics.increment('memory_scans_total')
+    metrics.increment('memory_changes_total', len(records))
+    return records
+
+
+def record_telemetry(kind, data=None):
+    telemetry = current_session().telemetry
+    if telemetry is not None:
+        telemetry.record(kind, data)
+
+
+def format_timings(timings):
+    return ', '.join('{0} {1:.3f}s'.format(k, v) for (k, v) in timings.items())
 
 
 class TableObject():
+    _tables_list = None
+    _specs = {}
+
     def __init__(self, pointer, index):
         self.pointer = pointer
         self.index = index
         self.old_data = {}
-        if not hasattr(self.__class__, '_every'):
-            self.__class__._every = []
-        self.__class__._every.append(self)
+        tables = current_session().tables
+        if self.__class__ not in tables:
+            tables[self.__class__] = []
+        tables[self.__class__].append(self)
 
     def __repr__(self):
         s = '{0} {1:0>2X}\n'.format(self.__class__.__name__, self.index)
@@ -407,8 +1414,13 @@ class TableObject():
         return s.strip()
 
     @classmethod
-    def load_all(cls):
+    def read_tables_list(cls):
+        # Shared by every table class, so the list and each specs file are
+        # only read once.
+        if TableObject._tables_list is not None:
+            return TableObject._tables_list
         TABLE_FILE = path.join(tblpath, 'tables_list.txt')
+        tables_list = {}
         f = open(TABLE_FILE)
         for line in f.readlines():
             if '#' in line:
@@ -424,42 +1436,55 @@ class TableObject():
             class_name, specs_filename, address, number = line.split()
             address = int(address, 0x10)
             number = int(number)
-            if class_name == cls.__name__:
-                specs_filepath = path.join(tblpath, specs_filename)
-                g = open(specs_filepath)
-                specs = []
-                for line in g.readlines():
-                    line = line.strip()
-                    if line.count(',') == 2:
-                        attribute, length, datatype = line.split(',')
-                        length = int(length)
-                        specs.append((attribute, length, datatype))
-                    else:
-                        attribute, misc = line.split(',')
-                        try:
-                            length = int(misc)
-                            specs.append((attribute, length, 'int'))
-                        except ValueError:
-                            datatype = misc
-                            specs.append((attribute, 1, datatype))
-                g.close()
-
-                cls.specs = specs
-                cls.name_bits()
-                full_length = sum([length for _, length, _ in specs])
-                for index in range(number):
-                    pointer = address + (full_length * index)
-                    cls(pointer, index)
+            if class_name not in tables_list:
+                tables_list[class_name] = (specs_filename, address, number)
+        f.close()
+        TableObject._tables_list = tables_list
+        return tables_list
 
-                break
-        else:
+    @classmethod
+    def read_specs(cls, specs_filename):
+        if specs_filename in TableObject._specs:
+            return TableObject._specs[specs_filename]
+        specs_filepath = path.join(tblpath, specs_filename)
+        g = open(specs_filepath)
+        specs = []
+        for line in g.readlines():
+            line = line.strip()
+            if line.count(',') == 2:
+                attribute, length, datatype = line.split(',')
+                length = int(length)
+                specs.append((attribute, length, datatype))
+            else:
+                attribute, misc = line.split(',')
+                try:
+                    length = int(misc)
+                    specs.append((attribute, length, 'int'))
+                except ValueError:
+                    datatype = misc
+                    specs.append((attribute, 1, datatype))
+        g.close()
+        TableObject._specs[specs_filename] = specs
+        return specs
+
+    @classmethod
+    def load_all(cls):
+        tables_list = cls.read_tables_list()
+        if cls.__name__ not in tables_list:
             raise Exception(
                 'Unable to find specs file: {0}'.format(cls.__name__))
-        f.close()
+        specs_filename, address, number = tables_list[cls.__name__]
+        specs = list(cls.read_specs(specs_filename))
+        cls.specs = specs
+        cls.name_bits()
+        full_length = sum([length for _, length, _ in specs])
+        for index in range(number):
+            pointer = address + (full_length * index)
+            cls(pointer, index)
 
     @classproperty
     def every(cls):
-        return list(cls._every)
+        return list(current_session().tables.get(cls, []))
 
     @classmethod
     def get(cls, index):
@@ -552,80 +1577,104 @@ class TableObject():
 
 
 class BurroughsClient():
-    ADDRESS = config['Server']['address']
-    PORT = int(config['Server']['port'])
-    POLL_INTERVAL = max(int(config['Server']['poll_interval']), 1)
+    LISTEN_TIMEOUT = 1
+    SEEN_LENGTH = 64
 
     def __init__(self):
-        self.previous_poll = 0
+        self.address = config['Server']['address']
+        self.port = int(config['Server']['port'])
+        self.keepalive_interval = max(
+            int(config['Server']['keepalive_interval']), 1)
+        self.serial_number = int(config['Server']['serial_number'])
+        self.previous_keepalive = 0
         self.jobs = []
         self.server_socket = None
+        self.command_table = list(config['Commands'].keys())
+        self.allowed_commands = [c for c in self.command_table
+                                 if check_command_allowed(c)]
+        self.digest = relay_protocol.command_digest(self.allowed_commands)
+        self.dictionary = relay_protocol.build_dictionary(self.command_table)
         self.connect_server()
-        self.seen = set([])
+        self.reset_seen()
+
+    def reset_seen(self):
+        self.confirmed = -1
+        self.seen = deque(maxlen=self.SEEN_LENGTH)
 
-    def poll_wait(self):
+    def keepalive(self):
         now = time()
-        delta = now - self.previous_poll
-        if delta < self.POLL_INTERVAL:
-            sleep(self.POLL_INTERVAL - delta)
-        self.previous_poll = now
+        if now - self.previous_keepalive >= self.keepalive_interval:
+            self.send_server(relay_protocol.KEEPALIVE,
+                             relay_protocol.encode_keepalive(self.digest))
+            self.previous_keepalive = now
 
     def connect_server(self):
         if self.server_socket and self.server_socket.fileno() >= 0:
             self.server_socket.close()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.connect((self.ADDRESS, self.PORT))
-        self.server_socket.settimeout(self.POLL_INTERVAL)
-
-    def send_server(self, msg):
-        msg = '{0} {1}'.format(SERIAL_NUMBER, msg)
-        msg = msg.encode()
-        compressed_msg = b'!' + compress(msg)
-        if len(compressed_msg) < len(msg):
-            msg = compressed_msg
+        self.server_socket.connect((self.address, self.port))
+        self.server_socket.settimeout(self.LISTEN_TIMEOUT)
+
+    def send_server(self, message_type, payload=b''):
+        msg = relay_protocol.encode_message(message_type, payload,
+                                            serial_number=self.serial_number)
         self.server_socket.send(msg)
 
     def listen_server(self):
-        msg = self.server_socket.recv(4096)
-        if msg and msg[0] == ord('!'):
-            msg = decompress(msg[1:])
-        msg = msg.decode('ascii').strip()
-        return msg
+        msg = self.server_socket.recv(relay_protocol.MAX_DATAGRAM_LENGTH)
+        message_type, _, payload = relay_protocol.decode_message(
+            msg, dictionary=self.dictionary)
+        return message_type, payload
 
     def poll(self):
-        self.poll_wait()
-        self.send_server('?')
+        self.keepalive()
+        if self.jobs:
+            return self.jobs.pop(0)
         try:
-            msg = self.listen_server()
-            if msg == '?':
+            message_type, payload = self.listen_server()
+            if message_type == relay_protocol.REQUEST_REPORT:
+                # The relay may ask again at any time, so what was confirmed
+                # is kept. A restarted relay learns it from the confirm.
                 self.report()
-            elif msg == '.':
-                pass
-            elif msg:
-                index_commands = [ic.strip() for ic in msg.split(',')]
-                to_confirm = []
-                for index_command in index_commands:
-                    index, command = index_command.split('-',1)
-                    to_confirm.append(index)
-                    if index in self.seen:
+                self.confirm(self.confirmed)
+            elif message_type == relay_protocol.COMMANDS:
+                index_commands = relay_protocol.decode_commands(
+                    payload, self.command_table)
+                for index, command in index_commands:
+                    if index <= self.confirmed or index in self.seen:
                         continue
-                    self.seen.add(index)
+                    self.seen.append(index)
                     self.jobs.append(command_to_job(command))
-                self.confirm(to_confirm)
+                while self.confirmed + 1 in self.seen:
+                    self.confirmed += 1
+                self.confirm(self.confirmed)
         except socket.timeout:
             pass
         if self.jobs:
             j = self.jobs.pop(0)
             return j
 
+    def get_rate_limits(self):
+        rate_limits = {}
+        for scope in relay_protocol.RATE_LIMITS:
+            key = '{0}_rate_limit'.format(scope)
+            if key in config['Chat']:
+                count, seconds = config['Chat'][key].split('/')
+                rate_limits[scope] = (int(count), int(seconds))
+        return rate_limits
+
     def report(self):
-        status = '#{0} {1}'.format(config['Chat']['channel'],
-                                   config['Chat']['allowed_users'])
-        self.send_server(status)
+        allowed_users = config['Chat']['allowed_users'].split(',')
+        payload = relay_protocol.encode_report(config['Chat']['channel'],
+                                               allowed_users,
+                                               self.command_table,
+                                               self.get_rate_limits(),
+                                               self.allowed_commands)
+        self.send_server(relay_protocol.REPORT, payload)
 
-    def confirm(self, to_confirm):
-        msg = '+{0}'.format(','.join(to_confirm))
-        self.send_server(msg)
+    def confirm(self, confirmed):
+        self.send_server(relay_protocol.CONFIRM,
+                         relay_protocol.encode_confirm(confirmed))
 
 
 def dispatch_to_job(handler_name, *args, **kwargs):
@@ -633,18 +1682,27 @@ def dispatch_to_job(handler_name, *args, **kwargs):
     return handler(*args, **kwargs)
 
 
-def command_to_job(command):
+def check_command_allowed(command, verbose=False):
     whitelist = [c.strip()
                  for c in config['Misc']['whitelist_commands'].split(',')]
     blacklist = [c.strip()
                  for c in config['Misc']['blacklist_commands'].split(',')]
 
     if whitelist and '*' not in whitelist and command not in whitelist:
-        log('Command %s not whitelisted.' % command)
-        return
+        if verbose:
+            log('Command %s not whitelisted.' % command)
+        return False
 
     if blacklist and command in blacklist or '*' in blacklist:
-        log('Command %s blacklisted.' % command)
+        if verbose:
+            log('Command %s blacklisted.' % command)
+        return False
+
+    return True
+
+
+def command_to_job(command):
+    if not check_command_allowed(command, verbose=True):
         return
 
     try:
@@ -657,26 +1715,49 @@ def command_to_job(command):
         else:
             handler_name, args = s, []
         log('Running command: %s %s %s' % (command, handler_name, args))
-        return dispatch_to_job(handler_name, command, *args)
+        with supervisor.working():
+            return dispatch_to_job(handler_name, command, *args)
     except:
         log('Command error: %s' % command)
         log(traceback.format_exc())
 
 
-JOBS = []
-
-
 def process_jobs():
+    session = current_session()
+    last_probe, last_mirror, last_scan = time(), 0, 0
     while True:
-        myjobs = list(JOBS)
-        random.shuffle(myjobs)
-        for j in myjobs:
-            if j.finished:
-                log('Completed job: %s' % j)
-                JOBS.remove(j)
-            else:
-                j.run()
-        sleep(UPDATE_INTERVAL)
+        j = None
+        with supervisor.working():
+            try:
+                if (session.integrity_interval and time() - last_probe
+                        >= session.integrity_interval):
+                    probe_integrity()
+                    last_probe = time()
+                if (session.mirror is not None and time() - last_mirror
+                        >= session.mirror_interval):
+                    publish_mirror()
+                    last_mirror = time()
+                if (session.scanner is not None
+                        and (session.scan_pending or time() - last_scan
+                             >= session.scan_interval)):
+                    if scan_memory() is not None:
+                        last_scan = time()
+                myjobs = list(JOBS)
+                random.shuffle(myjobs)
+                for j in myjobs:
+                    if j.finished:
+                        log('Completed job: %s' % j)
+                        JOBS.remove(j)
+                        metrics.increment('jobs_completed_total')
+                        if hasattr(j, 'queued_at'):
+                            metrics.observe('job_duration_seconds',
+                                            time() - j.queued_at)
+                    else:
+                        j.run()
+            except OSError:
+                log(traceback.format_exc(), debug=True)
+                supervisor.interrupt(j)
+        sleep(session.update_interval)
 
 
 def input_job_from_command_line():
@@ -684,6 +1765,7 @@ def input_job_from_command_line():
     try:
         command = input('COMMAND: ')
     except EOFError:
+        close_files()
         _exit(0)
 
     if command == '!debug':
@@ -718,7 +1800,8 @@ def acquire_jobs():
         burroughs_client = None
 
     while True:
-        sleep(UPDATE_INTERVAL)
+        sleep(current_session().update_interval)
+        supervisor.link_up.wait()
         job = None
         if mode == 'manual':
             job = input_job_from_command_line()
@@ -731,7 +1814,9 @@ def acquire_jobs():
 
         if job is not None:
             log('Adding job: %s' % job)
+            job.queued_at = time()
             JOBS.append(job)
+            metrics.increment('jobs_added_total')
             log('Jobs (%s): %s' % (len(JOBS),
                                    ','.join([str(j) for j in JOBS])))
             if mode == 'random':
@@ -745,6 +1830,7 @@ def acquire_jobs():
                         if j in disposable:
                             log('Dropped job: %s (queue too big)' % j)
                             JOBS.remove(j)
+                            metrics.increment('jobs_dropped_total')
                             break
                 sleep(int(config['Misc']['random_interval']))
 
@@ -764,55 +1850,107 @@ def load_objects(imported_globals):
         obj.load_all()
 
 
+def collect_job_metrics():
+    # Called from the metrics server's thread, which has no session of its
+    # own, so every running session is reported with its name.
+    now = time()
+    sessions = list(SESSIONS)
+    queued, ages = [], []
+    for session in sessions:
+        depths = {}
+        session_ages = []
+        for j in list(session.jobs):
+            if hasattr(j, 'LOCK_KEY'):
+                address, bit = j.LOCK_KEY
+                domain = '{0:0>6x}:{1:0>2x}'.format(address, bit)
+            else:
+                domain = 'none'
+            depths[domain] = depths.get(domain, 0) + 1
+            if hasattr(j, 'queued_at'):
+                session_ages.append(now - j.queued_at)
+        queued += [('jobs_queued', {'session': session.name, 'lock': domain},
+                    depth) for (domain, depth) in sorted(depths.items())]
+        ages += [('job_age_seconds', {'session': session.name, 'quantile': q},
+                  percentile(session_ages, q)) for q in [0.5, 0.9, 0.99]]
+    gauges = queued + ages
+    for name, value in [
+            ('client_lock_held', lambda s: int(s.client.lock)),
+            ('emulator_link_up',
+             lambda s: int(s.supervisor.link_up.is_set())),
+            ('emulator_breaker_open',
+             lambda s: int(s.client.breaker.is_open)),
+            ('emulator_heartbeat_latency_seconds',
+             lambda s: s.supervisor.latency)]:
+        for session in sessions:
+            if value(session) is not None:
+                gauges.append((name, {'session': session.name},
+                               value(session)))
+    return gauges
+
+
 def initialize_ramtools(imported_globals):
+    if current_session() not in SESSIONS:
+        SESSIONS.append(current_session())
+    if ('trace_file' in config['Misc'] and config['Misc']['trace_file']
+            and not tracer.enabled):
+        tracer.open(config['Misc']['trace_file'])
+    if ('metrics_port' in config['Misc'] and config['Misc']['metrics_port']
+            and metrics.server is None):
+        if metrics.serve(config['Misc']['metrics_port']):
+            metrics.add_collector(collect_job_metrics)
+            metrics.set_labeller(lambda: {'session': current_session().name})
+    if 'record_file' in config['Misc'] and config['Misc']['record_file']:
+        client.recorder = Recorder(config['Misc']['record_file'])
+        atexit.register(client.recorder.close)
+    start = perf_counter()
     register_handlers(imported_globals)
     load_objects(imported_globals)
+    STARTUP_TIMINGS['tables'] = perf_counter() - start
     log('Waiting for emulator...', debug=True)
     seen_emulator = False
+    client.connect_emulator()
     while True:
-        sleep(1)
-        client.connect_emulator()
         status = client.get_status()
+        if status == 'PLAYING':
+            break
         if status == 'CONTENTLESS' and not seen_emulator:
             seen_emulator = True
             log('Emulator detected. Waiting for the game to be loaded.',
                 debug=True)
-        if client.get_status() == 'PLAYING':
-            break
+        if status == 'NONRESPONSIVE':
+            client.connect_emulator()
+        sleep(STARTUP_POLL_INTERVAL)
+    current_session().playing_at = perf_counter()
 
 
 def begin_job_management():
-    acquire_thread, process_thread = None, None
-    acquire_thread = Thread(target=acquire_jobs, daemon=True)
-    acquire_thread.start()
-    process_thread = Thread(target=process_jobs, daemon=True)
-    process_thread.start()
-
-    log('Beginning main loop.', debug=True)
-    counter = 0
+    session = current_session()
+    threads = {}
+    if (('mirror_name' in config['Misc'] and config['Misc']['mirror_name'])
+            or ('mirror_file' in config['Misc']
+                and config['Misc']['mirror_file'])):
+        open_mirror()
+    if session.scan_interval:
+        open_scanner()
+    if session.playing_at is not None:
+        STARTUP_TIMINGS['since playing'] = perf_counter() - session.playing_at
+    log('Beginning main loop. Startup: %s' % format_timings(STARTUP_TIMINGS),
+        debug=True)
     client.show_message('Beyond Backseat is now running.')
     while True:
-        sleep(1)
-        now = int(time())
-        if now % 10 == 3:
-            acquire_thread.join()
-        if now % 10 == 7:
-            process_thread.join()
         try:
-            if not acquire_thread.is_alive():
-                acquire_thread = Thread(target=acquire_jobs, daemon=True)
-                acquire_thread.start()
-            if not process_thread.is_alive():
-                client.connect_emulator()
-                process_thread = Thread(target=process_jobs, daemon=True)
-                process_thread.start()
+            for target in [acquire_jobs, process_jobs]:
+                thread = threads.get(target)
+                if thread is not None and thread.is_alive():
+                    continue
+                if thread is not None:
+                    log('Restarting %s.' % target.__name__, debug=True)
+                threads[target] = Thread(target=session.run, args=(target,),
+                                         daemon=True)
+                threads[target].start()
+            supervisor.watch()
         except(KeyboardInterrupt):
+            close_files()
             _exit(0)
         except:
             log(traceback.format_exc(), debug=True)
-            client.connect_emulator()
-            client.release_lock()
-            if not process_thread.is_alive():
-                process_thread = Thread(target=process_jobs, daemon=True)
-                process_thread.start()
-        counter += 1
@@ -0,0 +1,200 @@
+import zlib
+
+# Every datagram starts with one byte holding the message type in the low
+# bits and a compression flag in the high bit. Messages from a streamer to
+# the relay follow it with the streamer's serial number as a varint.
+KEEPALIVE = 0x01
+REPORT = 0x02
+CONFIRM = 0x03
+REQUEST_REPORT = 0x04
+COMMANDS = 0x05
+
+RATE_LIMITS = ['channel', 'user', 'command']
+
+COMPRESSED = 0x80
+TYPE_MASK = 0x7f
+COMPRESS_THRESHOLD = 48
+MAX_DATAGRAM_LENGTH = 4096
+MAX_HEADER_LENGTH = 16
+
+
+def encode_varint(value):
+    assert value >= 0
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def decode_varint(data, offset):
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_string(s):
+    s = s.encode()
+    return encode_varint(len(s)) + s
+
+
+def decode_string(data, offset):
+    length, offset = decode_varint(data, offset)
+    s = data[offset:offset+length]
+    if len(s) != length:
+        raise ValueError('Truncated string.')
+    return s.decode(), offset + length
+
+
+def build_dictionary(command_names):
+    return '\n'.join(command_names).encode()
+
+
+def compress(payload, dictionary=None):
+    if dictionary:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def decompress(payload, dictionary=None):
+    if dictionary:
+        decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj(-15)
+    return decompressor.decompress(payload) + decompressor.flush()
+
+
+def encode_message(message_type, payload=b'', serial_number=None,
+                   dictionary=None):
+    header = message_type
+    if len(payload) >= COMPRESS_THRESHOLD:
+        compressed = compress(payload, dictionary)
+        if len(compressed) < len(payload):
+            header |= COMPRESSED
+            payload = compressed
+    msg = bytes([header])
+    if serial_number is not None:
+        msg += encode_varint(serial_number)
+    msg += payload
+    assert len(msg) < MAX_DATAGRAM_LENGTH
+    return msg
+
+
+def decode_message(msg, has_serial=False, dictionary=None):
+    header, offset = msg[0], 1
+    serial_number = None
+    if has_serial:
+        serial_number, offset = decode_varint(msg, offset)
+    payload = msg[offset:]
+    if header & COMPRESSED:
+        payload = decompress(payload, dictionary)
+    return header & TYPE_MASK, serial_number, payload
+
+
+def command_length(command):
+    if isinstance(command, int):
+        return len(encode_varint(command + 1))
+    return 1 + len(encode_string(command))
+
+
+def encode_commands(first_index, commands):
+    # Commands are sent as indexes into the streamer's reported command
+    # table. Anything not in the table is sent as a literal string.
+    payload = encode_varint(first_index) + encode_varint(len(commands))
+    for command in commands:
+        if isinstance(command, int):
+            payload += encode_varint(command + 1)
+        else:
+            payload += encode_varint(0) + encode_string(command)
+    return payload
+
+
+def decode_commands(payload, command_table):
+    first_index, offset = decode_varint(payload, 0)
+    count, offset = decode_varint(payload, offset)
+    index_commands = []
+    for index in range(first_index, first_index + count):
+        command_id, offset = decode_varint(payload, offset)
+        if command_id:
+            command = command_table[command_id - 1]
+        else:
+            command, offset = decode_string(payload, offset)
+        index_commands.append((index, command))
+    return index_commands
+
+
+def command_digest(commands):
+    return zlib.crc32('\n'.join(sorted(commands)).encode())
+
+
+def encode_keepalive(digest):
+    return digest.to_bytes(4, 'little')
+
+
+def decode_keepalive(payload):
+    if len(payload) < 4:
+        return None
+    return int.from_bytes(payload[:4], 'little')
+
+
+def encode_report(channel, allowed_users, command_table, rate_limits=None,
+                  allowed_commands=None):
+    payload = encode_string(channel) + encode_string(','.join(allowed_users))
+    payload += encode_varint(len(command_table))
+    # The allowed commands are sent as a bitmap over the command table.
+    bitmap = bytearray((len(command_table) + 7) // 8)
+    for i, command in enumerate(command_table):
+        payload += encode_string(command)
+        if allowed_commands is None or command in allowed_commands:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    payload += bytes(bitmap)
+    for scope in RATE_LIMITS:
+        if rate_limits and scope in rate_limits:
+            count, seconds = rate_limits[scope]
+        else:
+            count, seconds = 0, 0
+        payload += encode_varint(count) + encode_varint(seconds)
+    return payload
+
+
+def decode_report(payload):
+    channel, offset = decode_string(payload, 0)
+    allowed_users, offset = decode_string(payload, offset)
+    allowed_users = [au.strip() for au in allowed_users.split(',')]
+    count, offset = decode_varint(payload, offset)
+    command_table = []
+    for _ in range(count):
+        command, offset = decode_string(payload, offset)
+        command_table.append(command)
+    bitmap = payload[offset:offset+((count + 7) // 8)]
+    offset += len(bitmap)
+    allowed_commands = [command for (i, command) in enumerate(command_table)
+                        if bitmap[i >> 3] & (1 << (i & 7))]
+    rate_limits = {}
+    for scope in RATE_LIMITS:
+        count, offset = decode_varint(payload, offset)
+        seconds, offset = decode_varint(payload, offset)
+        if count and seconds:
+            rate_limits[scope] = (count, seconds)
+    return (channel.strip(), allowed_users, command_table, allowed_commands,
+            rate_limits)
+
+
+def encode_confirm(confirmed):
+    return encode_varint(confirmed + 1)
+
+
+def decode_confirm(payload):
+    confirmed, _ = decode_varint(payload, 0)
+    return confirmed - 1
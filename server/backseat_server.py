@@ -1,111 +1,361 @@
-import gzip
+import asyncio
 import socket
+from collections import OrderedDict, deque
+from multiprocessing import get_context
+from os import environ, path
+from sys import path as sys_path
+from threading import Thread
+from time import time
 
-POLL_INTERVAL = 0.5
+try:
+    import relay_protocol
+except ImportError:
+    sys_path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    import relay_protocol
+from ratelimit import RateLimiter, allow_all
+
+TICK_INTERVAL = 0.1
+RETRANSMIT_INTERVAL = 0.5
+MAX_RETRANSMIT_INTERVAL = 8
+CLIENT_TIMEOUT = 300
+MAX_COMMAND_LENGTH = 64
+WINDOW_SIZE = 16
+MAX_PENDING_COMMANDS = 256
+DEDUP_WINDOW = 3
 SERVER_IP = '127.0.0.1'
 SERVER_PORT = 55333
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.settimeout(POLL_INTERVAL)
+WORKERS = int(environ.get('BACKSEAT_WORKERS', 1))
 
 
 class Client:
-    def __init__(self, address, port, serial_number):
+    def __init__(self, relay, address, port, serial_number):
+        self.relay = relay
         self.address = address
         self.port = port
         self.serial_number = serial_number
         self.next_command_index = 0
-        self.index_commands = []
+        self.index_commands = deque()
+        self.dropped_commands = 0
+        self.invalid_commands = 0
+        self.duplicate_commands = 0
+        self.recent_commands = {}
         self.channel = None
         self.allowed_users = set([])
+        self.command_ids = {}
+        self.allowed_commands = frozenset()
+        self.digest = None
+        self.dictionary = None
+        self.rate_limits = {}
+        self.retransmit_count = 0
+        self.retransmit_at = None
+        self.last_seen = time()
 
     @property
     def signature(self):
         return self.address, self.port
 
-    def send(self, msg):
-        msg = msg.encode()
-        temp = b'!' + gzip.compress(msg)
-        if len(temp) < len(msg):
-            msg = temp
-        assert len(msg) < 4096
-        server_socket.sendto(msg, self.signature)
-
-    def process_report(self, msg):
-        channel, allowed_users = msg.split(' ', 1)
-        allowed_users = [au.strip() for au in allowed_users.split(',')]
-        self.channel = channel.strip()
+    def send(self, message_type, payload=b''):
+        msg = relay_protocol.encode_message(message_type, payload,
+                                            dictionary=self.dictionary)
+        self.relay.sendto(msg, self.signature)
+
+    def process_report(self, payload):
+        (channel, allowed_users, command_table, allowed_commands,
+         rate_limits) = relay_protocol.decode_report(payload)
+        self.channel = channel
         self.allowed_users = set(allowed_users)
+        self.command_ids = {command: command_id for (command_id, command)
+                            in enumerate(command_table)}
+        self.allowed_commands = frozenset(allowed_commands)
+        self.digest = relay_protocol.command_digest(allowed_commands)
+        self.dictionary = relay_protocol.build_dictionary(command_table)
+        for scope in relay_protocol.RATE_LIMITS:
+            limiter = self.rate_limits.get(scope)
+            if scope not in rate_limits:
+                self.rate_limits.pop(scope, None)
+            elif (limiter is None or
+                    (limiter.count, limiter.seconds) != rate_limits[scope]):
+                self.rate_limits[scope] = RateLimiter(*rate_limits[scope])
+
+    def allow_user(self, user):
+        return user in self.allowed_users or '*' in self.allowed_users
+
+    def check_command(self, command, now):
+        if command not in self.allowed_commands:
+            self.invalid_commands += 1
+            return False
+        # Collapse the same command from many viewers into one.
+        if now - self.recent_commands.get(command, 0) < DEDUP_WINDOW:
+            self.duplicate_commands += 1
+            return False
+        return True
+
+    def allow_command(self, user, command):
+        return allow_all([(self.rate_limits.get('channel'), None),
+                          (self.rate_limits.get('user'), user),
+                          (self.rate_limits.get('command'), command)])
 
     def get_channel(self):
-        self.send('?')
+        self.send(relay_protocol.REQUEST_REPORT)
 
-    def add_command(self, command):
+    def add_command(self, command, now):
+        if (len(command) > MAX_COMMAND_LENGTH
+                or len(self.index_commands) >= MAX_PENDING_COMMANDS):
+            self.dropped_commands += 1
+            return False
+        # Only a command that was queued blocks its duplicates.
+        self.recent_commands[command] = now
         self.index_commands.append((self.next_command_index, command))
         self.next_command_index += 1
+        return len(self.index_commands) <= WINDOW_SIZE
+
+    def get_window(self):
+        window, length = [], relay_protocol.MAX_HEADER_LENGTH
+        for index, command in self.index_commands:
+            if command in self.command_ids:
+                command = self.command_ids[command]
+            length += relay_protocol.command_length(command)
+            if (len(window) >= WINDOW_SIZE
+                    or length >= relay_protocol.MAX_DATAGRAM_LENGTH):
+                break
+            window.append(command)
+        return window
 
     def send_commands(self):
         if self.index_commands:
-            msg = ','.join(['{0}-{1}'.format(index, command)
-                            for (index, command) in self.index_commands])
-            self.send(msg)
-
-    def process_seen(self, msg):
-        confirmed = set([int(index.strip()) for index in msg.split(',')])
-        self.index_commands = [
-            (index, command) for (index, command) in self.index_commands
-            if index not in confirmed]
-
-    def process_message(self, msg):
-        msg = msg.strip()
-        if msg == '?':
+            first_index = self.index_commands[0][0]
+            payload = relay_protocol.encode_commands(first_index,
+                                                     self.get_window())
+            self.send(relay_protocol.COMMANDS, payload)
+            interval = min(RETRANSMIT_INTERVAL * (2 ** self.retransmit_count),
+                           MAX_RETRANSMIT_INTERVAL)
+            self.retransmit_at = time() + interval
+            self.retransmit_count += 1
+
+    def retransmit(self, now):
+        if (self.index_commands and self.retransmit_at is not None
+                and now >= self.retransmit_at):
+            self.send_commands()
+
+    def process_seen(self, payload):
+        confirmed = relay_protocol.decode_confirm(payload)
+        if confirmed >= self.next_command_index:
+            # The client confirmed commands this relay never sent, so the
+            # relay was restarted. Numbering carries on from the client's.
+            first_index = confirmed + 1
+            self.index_commands = deque(
+                (first_index + i, command)
+                for (i, (_, command)) in enumerate(self.index_commands))
+            self.next_command_index = first_index + len(self.index_commands)
+        advanced = False
+        while self.index_commands and self.index_commands[0][0] <= confirmed:
+            self.index_commands.popleft()
+            advanced = True
+        if advanced:
+            self.retransmit_count = 0
+            self.retransmit_at = None
+            self.send_commands()
+
+    def process_message(self, message_type, payload):
+        if message_type == relay_protocol.KEEPALIVE:
+            digest = relay_protocol.decode_keepalive(payload)
+            if digest is not None and digest != self.digest:
+                self.get_channel()
             self.send_commands()
-        elif msg.startswith('#'):
-            self.process_report(msg[1:])
-        elif msg.startswith('+'):
-            self.process_seen(msg[1:])
+        elif message_type == relay_protocol.REPORT:
+            self.process_report(payload)
+        elif message_type == relay_protocol.CONFIRM:
+            self.process_seen(payload)
         else:
             raise Exception('Unknown message')
 
 
-class Server():
-    clients = []
+class Relay(asyncio.DatagramProtocol):
+    def __init__(self, on_channels=None):
+        self.clients = OrderedDict()
+        self.channel_clients = {}
+        self.channels = frozenset()
+        self.pending_clients = set([])
+        self.dirty_clients = set([])
+        self.outbox = []
+        self.on_channels = on_channels
+        self.transport = None
+        self.loop = None
 
-    @classmethod
-    def get_channels(self):
-        return {'#{0}'.format(c.channel) for c in self.clients if c.channel}
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_event_loop()
+        self.loop.call_later(TICK_INTERVAL, self.tick)
 
-    def receive(self):
+    def datagram_received(self, msg, addr):
+        address, port = addr[:2]
         try:
-            msg, (address, port) = server_socket.recvfrom(4096)
-        except socket.timeout:
-            return None
-        if msg[0] == ord('!'):
-            msg = gzip.decompress(msg[1:])
-        msg = msg.decode('ascii').strip()
-        return msg, (address, port)
+            message_type, serial_number, payload = (
+                relay_protocol.decode_message(msg, has_serial=True))
+        except Exception:
+            return
+        client = self.get_client(address, port, serial_number)
+        old_channel = client.channel
+        client.process_message(message_type, payload)
+        if client.channel != old_channel:
+            self.index_channel(client, old_channel)
+        if client.index_commands:
+            self.pending_clients.add(client)
+        else:
+            self.pending_clients.discard(client)
+
+    def sendto(self, msg, signature):
+        if not self.outbox and not self.dirty_clients:
+            self.loop.call_soon(self.flush)
+        self.outbox.append((msg, signature))
+
+    def push(self, client):
+        if not self.outbox and not self.dirty_clients:
+            self.loop.call_soon(self.flush)
+        self.dirty_clients.add(client)
+        self.pending_clients.add(client)
+
+    def flush(self):
+        for c in self.dirty_clients:
+            c.retransmit_count = 0
+            c.send_commands()
+        self.dirty_clients = set([])
+        outbox, self.outbox = self.outbox, []
+        for msg, signature in outbox:
+            self.transport.sendto(msg, signature)
+
+    def tick(self):
+        self.loop.call_later(TICK_INTERVAL, self.tick)
+        now = time()
+        for c in list(self.pending_clients):
+            c.retransmit(now)
+        self.expire_clients(now)
 
     def get_client(self, address, port, serial_number):
-        for c in self.clients:
+        key = (address, port, serial_number)
+        if key in self.clients:
+            c = self.clients[key]
+            self.clients.move_to_end(key)
             if c.channel is None:
                 c.get_channel()
-            if (c.address == address and c.port == port
-                    and c.serial_number == serial_number):
-                return c
-        c = Client(address, port, serial_number)
-        self.clients.append(c)
+        else:
+            c = Client(self, address, port, serial_number)
+            self.clients[key] = c
+            c.get_channel()
+        c.last_seen = time()
         return c
 
-    def poll(self):
-        received = self.receive()
-        if received is not None:
-            msg, (address, port) = received
-            serial_number, msg = msg.split(' ', 1)
-            client = self.get_client(address, port, serial_number)
-            client.process_message(msg)
+    def index_channel(self, client, old_channel):
+        if old_channel is not None:
+            old_clients = self.channel_clients[old_channel]
+            old_clients.discard(client)
+            if not old_clients:
+                del self.channel_clients[old_channel]
+        if client.channel is not None:
+            if client.channel not in self.channel_clients:
+                self.channel_clients[client.channel] = set([])
+            self.channel_clients[client.channel].add(client)
+        channels = frozenset('#{0}'.format(channel)
+                             for channel in self.channel_clients)
+        if channels != self.channels:
+            self.channels = channels
+            if self.on_channels is not None:
+                self.on_channels(channels)
+
+    def remove_client(self, client):
+        del self.clients[client.address, client.port, client.serial_number]
+        self.pending_clients.discard(client)
+        self.dirty_clients.discard(client)
+        old_channel, client.channel = client.channel, None
+        self.index_channel(client, old_channel)
+
+    def expire_clients(self, now):
+        while self.clients:
+            c = next(iter(self.clients.values()))
+            if now - c.last_seen < CLIENT_TIMEOUT:
+                break
+            self.remove_client(c)
 
     def delegate_command(self, channel, user, command):
         channel = channel.lstrip('#')
-        for c in self.clients:
-            if c.channel == channel and user in c.allowed_users:
-                c.add_command(command)
+        now = time()
+        for c in self.channel_clients.get(channel, ()):
+            if (c.allow_user(user) and c.check_command(command, now)
+                    and c.allow_command(user, command)
+                    and c.add_command(command, now)):
+                self.push(c)
+
+
+def make_socket(reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((SERVER_IP, SERVER_PORT))
+    return s
+
+
+def run_relay(loop, relay, sock):
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(
+        loop.create_datagram_endpoint(lambda: relay, sock=sock))
+    loop.run_forever()
+
+
+def run_worker(conn):
+    # Each worker owns the clients that the kernel hashes to its socket.
+    # Chat commands arrive from the parent over conn, and channel changes
+    # are reported back the same way.
+    loop = asyncio.new_event_loop()
+    relay = Relay(on_channels=lambda channels: conn.send(sorted(channels)))
+
+    def receive_commands():
+        while conn.poll():
+            relay.delegate_command(*conn.recv())
+
+    loop.add_reader(conn.fileno(), receive_commands)
+    run_relay(loop, relay, make_socket(reuse_port=True))
+
+
+class Server():
+    def __init__(self, workers=WORKERS):
+        self.workers = []
+        self.worker_channels = []
+        self.channels = frozenset()
+        if workers > 1:
+            context = get_context('fork')
+            for _ in range(workers):
+                conn, child_conn = context.Pipe()
+                worker = context.Process(target=run_worker, args=(child_conn,),
+                                         daemon=True)
+                worker.start()
+                self.workers.append(conn)
+                self.worker_channels.append(frozenset())
+            self.relay = None
+        else:
+            self.loop = asyncio.new_event_loop()
+            self.relay = Relay()
+            Thread(target=run_relay, args=(self.loop, self.relay,
+                                           make_socket()),
+                   daemon=True).start()
+
+    def get_channels(self):
+        if self.relay is not None:
+            return self.relay.channels
+        return self.channels
+
+    def poll(self):
+        if self.relay is not None:
+            return
+        for i, conn in enumerate(self.workers):
+            while conn.poll():
+                self.worker_channels[i] = frozenset(conn.recv())
+        self.channels = frozenset().union(*self.worker_channels)
+
+    def delegate_command(self, channel, user, command):
+        if self.relay is not None:
+            self.loop.call_soon_threadsafe(self.relay.delegate_command,
+                                           channel, user, command)
+            return
+        for conn, channels in zip(self.workers, self.worker_channels):
+            if channel in channels:
+                conn.send((channel, user, command))
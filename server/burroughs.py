@@ -1,19 +1,30 @@
 from twisted.words.protocols import irc
 from twisted.internet import reactor, protocol
-from twisted.internet.error import ConnectionLost
 
-from datetime import datetime
+from collections import deque
 from os import environ
 from time import sleep
 import traceback
 
-from burroughs_plugins import Confusion, Greetings, Logger, Backseater
+from burroughs_plugins import (Confusion, Greetings, Logger, Backseater,
+                               Dispatcher)
+from ratelimit import TokenBucket
+from logwriter import LogWriter, timestamp
 
 
 NICKNAME = "burroughs_exe"
 NICKPASSWORD = environ['BURROUGHS_PASSWORD']
 CHANNELS = ["#abyssonym"]
 RESPOND_TO = ["burroughs_exe", "burroughs", "burroughs.exe"]
+IRC_HOST, IRC_PORT = "irc.twitch.tv", 6667
+
+# Twitch allows 20 joins per 10 seconds and 20 messages per 30 seconds for
+# each account, no matter how many connections it has open.
+JOIN_LIMIT = (20, 10)
+MESSAGE_LIMIT = (20, 30)
+JOIN_BATCH_SIZE = 10
+MAX_CHANNELS_PER_CONNECTION = 50
+MAX_CONNECTIONS = int(environ.get('BURROUGHS_CONNECTIONS', 8))
 
 PLUGINS = [
     Backseater(RESPOND_TO),
@@ -22,6 +33,8 @@ PLUGINS = [
     Logger(),
     ]
 
+DISPATCHER = Dispatcher(PLUGINS)
+
 DAEMONS = [
     Backseater,
     ]
@@ -29,43 +42,81 @@ DAEMONS = [
 SYSLOG_FILENAME = 'burroughs.log'
 
 
+SYSLOG = LogWriter(SYSLOG_FILENAME)
+
+
 def log(msg):
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    msg = '{0} {1}'.format(timestamp, msg)
+    msg = '{0} {1}'.format(timestamp(), msg)
     print(msg)
-    f = open(SYSLOG_FILENAME, 'a+')
-    f.write(msg)
-    f.close()
+    SYSLOG.write(msg + '\n')
 
 
 class Burroughs(irc.IRCClient):
     nickname = NICKNAME
     password = NICKPASSWORD
-    channels = set(CHANNELS)
     cooldown = 3.5
 
+    def connectionMade(self):
+        self.outbox = deque()
+        self.pending_joins = deque()
+        self.drain_call = None
+        super().connectionMade()
+
+    @property
+    def pool(self):
+        return self.factory.pool
+
+    @property
+    def channels(self):
+        return self.factory.channels
+
     def signedOn(self):
+        self.factory.connection = self
         self.msg("Q", "auth %s %s" % (self.nickname, self.password))
         sleep(0.5)
-        for channel in self.channels:
+        for channel in sorted(self.channels):
             self.join(channel)
-        self.msg(CHANNELS[0], "Good morning, Master.")
+        if self.factory.index == 0:
+            self.msg(CHANNELS[0], "Good morning, Master.")
         #if self.password:
         #    self.msg("NickServ", "IDENTIFY %s" % self.password)
         self.repeatingPing(59)
-        self.daemon()
 
     def repeatingPing(self, delay):
         reactor.callLater(delay, self.repeatingPing, delay)
         self.ping(self.nickname)
 
-    def daemon(self):
-        reactor.callLater(1, self.daemon)
-        for d in DAEMONS:
-            try:
-                d.daemon(self)
-            except Exception:
-                log(traceback.format_exc())
+    def join(self, channel, key=None):
+        if not channel.startswith('#'):
+            channel = '#%s' % channel
+        self.pending_joins.append(channel)
+        if self.drain_call is None:
+            self.drain_call = reactor.callLater(0, self.drain_later)
+
+    def msg(self, user, message, length=None):
+        self.outbox.append((user, message, length))
+        self.drain()
+
+    def drain_later(self):
+        self.drain_call = None
+        self.drain()
+
+    def drain(self):
+        batch_size = min(len(self.pending_joins), JOIN_BATCH_SIZE)
+        if batch_size and self.pool.join_bucket.consume(batch_size):
+            batch = [self.pending_joins.popleft() for _ in range(batch_size)]
+            self.sendLine('JOIN %s' % ','.join(batch))
+
+        while self.outbox and self.pool.message_bucket.consume():
+            irc.IRCClient.msg(self, *self.outbox.popleft())
+
+        if (self.pending_joins or self.outbox) and self.drain_call is None:
+            batch_size = min(len(self.pending_joins), JOIN_BATCH_SIZE)
+            delay = max(self.pool.join_bucket.wait_time(batch_size)
+                        if self.pending_joins else 0,
+                        self.pool.message_bucket.wait_time()
+                        if self.outbox else 0)
+            self.drain_call = reactor.callLater(delay, self.drain_later)
 
     def privmsg(self, user, channel, msg):
         try:
@@ -74,7 +125,7 @@ class Burroughs(irc.IRCClient):
             pass
 
         self.responded = False
-        for p in PLUGINS:
+        for p in DISPATCHER.route(self, channel, msg):
             try:
                 p.run(self, user, channel, msg)
             except Exception:
@@ -84,35 +135,84 @@ class Burroughs(irc.IRCClient):
         self.channels.add(channel)
 
     def left(self, channel):
-        self.channels = [c for c in self.channels if c != channel]
+        self.channels.discard(channel)
 
-    def clientConnectionLost(self, reason):
-        log("connection lost: %s" % reason)
-        if reactor.running:
-            reactor.stop()
-        raise ConnectionLost
+    def connectionLost(self, reason):
+        if self.drain_call is not None and self.drain_call.active():
+            self.drain_call.cancel()
+        if self.factory.connection is self:
+            self.factory.connection = None
+        super().connectionLost(reason)
 
 
 class BurroughsFactory(protocol.ClientFactory):
+    def __init__(self, pool, index, channels=()):
+        self.pool = pool
+        self.index = index
+        self.channels = set(channels)
+        self.connection = None
+
     def buildProtocol(self, addr):
         p = Burroughs()
         p.factory = self
         return p
 
     def clientConnectionLost(self, connector, reason):
-        log("lost connection: %s" % reason)
+        log("lost connection %s: %s" % (self.index, reason))
         connector.connect()
 
     def clientConnectionFailed(self, connector, reason):
-        log("connection failed: %s" % reason)
-        reactor.stop()
+        log("connection %s failed: %s" % (self.index, reason))
+        reactor.callLater(15, connector.connect)
+
+
+class ConnectionPool:
+    def __init__(self, max_connections=MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.join_bucket = TokenBucket.per(*JOIN_LIMIT)
+        self.message_bucket = TokenBucket.per(*MESSAGE_LIMIT)
+        self.factories = []
+        self.add_connection(CHANNELS)
+
+    @property
+    def channels(self):
+        return set().union(*[f.channels for f in self.factories])
+
+    def add_connection(self, channels=()):
+        f = BurroughsFactory(self, len(self.factories), channels)
+        self.factories.append(f)
+        reactor.connectTCP(IRC_HOST, IRC_PORT, f)
+        return f
+
+    def join(self, channel):
+        if any(channel in f.channels for f in self.factories):
+            return
+        candidates = [f for f in self.factories
+                      if len(f.channels) < MAX_CHANNELS_PER_CONNECTION]
+        if not candidates:
+            if len(self.factories) < self.max_connections:
+                self.add_connection([channel])
+                return
+            candidates = self.factories
+        f = min(candidates, key=lambda f: len(f.channels))
+        f.channels.add(channel)
+        if f.connection is not None:
+            f.connection.join(channel)
+
+    def daemon(self):
+        reactor.callLater(1, self.daemon)
+        for d in DAEMONS:
+            try:
+                d.daemon(self)
+            except Exception:
+                log(traceback.format_exc())
 
 
 if __name__ == '__main__':
     while True:
         try:
-            f = BurroughsFactory()
-            reactor.connectTCP("irc.twitch.tv", 6667, f)
+            pool = ConnectionPool()
+            reactor.callLater(1, pool.daemon)
             reactor.run()
         except Exception:
             sleep(15)
@@ -1,14 +1,44 @@
 import re
-from datetime import datetime
-from time import time
 from string import ascii_letters
 from random import choice, randint
 from backseat_server import Server
+from logwriter import LogWriter, timestamp
+from ratelimit import RateLimiter, TokenBucket
+
+
+class Dispatcher:
+    def __init__(self, plugins):
+        self.plugins = plugins
+        self.trigger_plugins = {}
+        for p in plugins:
+            for trigger in p.triggers or []:
+                trigger = trigger.lower()
+                if trigger not in self.trigger_plugins:
+                    self.trigger_plugins[trigger] = set([])
+                self.trigger_plugins[trigger].add(p)
+        self.always = [p for p in plugins if p.triggers is None]
+        triggers = sorted(self.trigger_plugins, key=lambda t: (-len(t), t))
+        self.regex = re.compile('|'.join(re.escape(t) for t in triggers), re.I)
+
+    def route(self, bot, channel, msg):
+        if channel == bot.nickname:
+            return self.plugins
+
+        matched = set([])
+        for m in self.regex.finditer(msg):
+            matched |= self.trigger_plugins[m.group().lower()]
+        if not matched:
+            return self.always
+        return [p for p in self.plugins if p in matched or p.triggers is None]
 
 
 class Base:
     regex = '$.'
     cooldown = 4
+    triggers = []
+
+    def __init__(self):
+        self.response_bucket = TokenBucket.per(1, self.cooldown)
 
     def match(self, msg):
         if isinstance(self.regex, str):
@@ -22,22 +52,19 @@ class Base:
         pass
 
     def respond(self, bot, channel, msg, override_cooldown=False):
-        now = time()
+        buckets = [self.response_bucket]
+        if hasattr(bot, 'response_bucket'):
+            buckets.append(bot.response_bucket)
         if not override_cooldown:
-            if hasattr(bot, 'responded') and bot.responded:
+            if getattr(bot, 'responded', False):
                 return
-            if hasattr(self, 'last_response'):
-                if now - self.last_response < self.cooldown:
-                    return
-            if (hasattr(bot, 'last_global_response') and
-                    hasattr(bot, 'global_cooldown')):
-                if now - bot.last_global_response < bot.global_cooldown:
-                    return
+            if any(b.wait_time() for b in buckets):
+                return
+        for b in buckets:
+            b.consume()
         bot.responded = True
         if msg:
             bot.msg(channel, msg)
-        self.last_response = time()
-        bot.last_global_response = self.last_response
 
     def run(self, bot, user, channel, msg):
         if channel == bot.nickname:
@@ -53,12 +80,12 @@ class Base:
 
 
 class Logger(Base):
+    triggers = None
     logname = 'logs.txt'
-    output = open(logname, 'a+', buffering=1)
+    output = LogWriter(logname)
 
     def execute(self, channel, user, msg):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.output.write('%s %s %s: %s\n' % (timestamp, channel, user, msg))
+        self.output.write('%s %s %s: %s\n' % (timestamp(), channel, user, msg))
 
     def run(self, bot, user, channel, msg):
         self.execute(channel, user, msg)
@@ -72,7 +99,9 @@ class Greetings(Base):
                    }
 
     def __init__(self, nicknames):
+        super().__init__()
         self.nicknames = nicknames
+        self.triggers = nicknames
 
     def match(self, msg):
         msg = msg.lower()
@@ -138,6 +167,8 @@ class Confusion(Base):
     cooldown = 60
 
     def __init__(self, nicknames):
+        super().__init__()
+        self.triggers = nicknames
         self.regex = r'.*(%s)' % '|'.join(nicknames)
 
     def run(self, bot, user, channel, msg):
@@ -160,8 +191,18 @@ class Confusion(Base):
 
 
 class Backseater(Base):
+    triggers = ['beyond']
+    USER_LIMIT = (5, 10)
+
     def __init__(self, nicknames):
+        super().__init__()
         self.nicknames = nicknames
+        self.user_limiter = RateLimiter(*self.USER_LIMIT)
+        nicknames = sorted(nicknames, key=lambda n: -len(n))
+        self.regex = re.compile(r'((?:[^a-z]|%s)*?)beyond(.*)' % '|'.join(
+            re.escape(n) for n in nicknames), re.I | re.S)
+        self.address_regex = re.compile('|'.join(
+            re.escape(n) for n in nicknames + ['!beyond']), re.I)
         if not hasattr(Backseater, 'server'):
             Backseater.server = Server()
 
@@ -173,22 +214,14 @@ class Backseater(Base):
             bot.join(channel)
 
     def execute(self, channel, user, msg):
-        msg = msg.lower()
-        if 'beyond' not in msg:
-            return
-        for n in self.nicknames + ['!beyond']:
-            if n.lower() in msg:
-                break
-        else:
+        matched = self.regex.match(msg)
+        if not matched or not self.address_regex.search(msg):
             return
 
-        a, b = msg.split('beyond', 1)
-        for n in sorted(self.nicknames, key=lambda nn: -len(nn)):
-            a = a.replace(n, '')
-        if set(a) & set('abcdefghijklmnopqrstuvwxyz'):
-            return
+        if not self.user_limiter.allow((channel, user)):
+            return True
 
-        b = b.strip()
+        b = matched.group(2).lower().strip()
         self.server.delegate_command(channel, user, b)
         return True
 
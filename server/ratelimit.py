@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from time import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time()
+
+    @classmethod
+    def per(cls, count, seconds):
+        return cls(count / seconds, count)
+
+    def refill(self, now=None):
+        if now is None:
+            now = time()
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + (elapsed * self.rate))
+        self.updated = now
+
+    def consume(self, tokens=1, now=None):
+        self.refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens=1, now=None):
+        self.refill(now)
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+
+class RateLimiter:
+    MAX_KEYS = 4096
+
+    def __init__(self, count, seconds):
+        self.count = count
+        self.seconds = seconds
+        self.buckets = OrderedDict()
+        self.rejected = 0
+
+    def get_bucket(self, key):
+        if key in self.buckets:
+            self.buckets.move_to_end(key)
+            return self.buckets[key]
+        bucket = TokenBucket.per(self.count, self.seconds)
+        self.buckets[key] = bucket
+        while len(self.buckets) > self.MAX_KEYS:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def allow(self, key=None):
+        if self.get_bucket(key).consume():
+            return True
+        self.rejected += 1
+        return False
+
+
+def allow_all(limiter_keys):
+    # Only spend tokens when every limiter has one to spend, so that a
+    # command rejected by one limiter does not count against the others.
+    now = time()
+    buckets = [(limiter, limiter.get_bucket(key))
+               for (limiter, key) in limiter_keys if limiter is not None]
+    for limiter, bucket in buckets:
+        if bucket.wait_time(now=now) > 0:
+            limiter.rejected += 1
+            return False
+    for limiter, bucket in buckets:
+        bucket.consume(now=now)
+    return True
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'server')]
+
+# ramtools reads beyond.cfg and the tables from the working directory, and
+# takes a configuration file from argv[1] when there is one.
+os.chdir(ROOT)
+del sys.argv[1:]
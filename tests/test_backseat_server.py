@@ -0,0 +1,104 @@
+import relay_protocol
+from backseat_server import WINDOW_SIZE, Client
+
+TABLE = ['airstrike', 'heal', 'quake']
+
+
+class Relay():
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, msg, signature):
+        self.sent.append(msg)
+
+
+def make_client():
+    client = Client(Relay(), '127.0.0.1', 55356, 1)
+    client.process_report(relay_protocol.encode_report(
+        'channel', ['*'], TABLE, allowed_commands=TABLE))
+    return client
+
+
+def last_commands(client):
+    message_type, _, payload = relay_protocol.decode_message(
+        client.relay.sent[-1], dictionary=client.dictionary)
+    assert message_type == relay_protocol.COMMANDS
+    return relay_protocol.decode_commands(payload, TABLE)
+
+
+def confirm(client, confirmed):
+    client.process_message(relay_protocol.CONFIRM,
+                           relay_protocol.encode_confirm(confirmed))
+
+
+def test_window_is_limited():
+    client = make_client()
+    results = [client.add_command('quake', 0)
+               for _ in range(WINDOW_SIZE + 4)]
+    assert results == [True] * WINDOW_SIZE + [False] * 4
+    client.send_commands()
+    commands = last_commands(client)
+    assert [i for (i, _) in commands] == list(range(WINDOW_SIZE))
+    assert {c for (_, c) in commands} == {'quake'}
+
+
+def test_literal_commands_are_sent_as_strings():
+    client = make_client()
+    client.add_command('heal', 0)
+    client.add_command('rename terra', 0)
+    client.send_commands()
+    assert last_commands(client) == [(0, 'heal'), (1, 'rename terra')]
+
+
+def test_cumulative_confirm_slides_the_window():
+    client = make_client()
+    for _ in range(WINDOW_SIZE + 4):
+        client.add_command('heal', 0)
+    client.send_commands()
+    sent = len(client.relay.sent)
+    confirm(client, 9)
+    assert [i for (i, _) in client.index_commands][0] == 10
+    assert len(client.relay.sent) == sent + 1
+    assert last_commands(client)[0][0] == 10
+    assert last_commands(client)[-1][0] == WINDOW_SIZE + 3
+    assert client.retransmit_count == 1
+
+
+def test_stale_confirm_changes_nothing():
+    client = make_client()
+    for _ in range(3):
+        client.add_command('heal', 0)
+    confirm(client, 1)
+    sent = len(client.relay.sent)
+    confirm(client, 0)
+    confirm(client, -1)
+    assert len(client.relay.sent) == sent
+    assert [i for (i, _) in client.index_commands] == [2]
+
+
+def test_retransmit_backs_off():
+    client = make_client()
+    client.add_command('heal', 0)
+    client.send_commands()
+    first = client.retransmit_at
+    client.retransmit(first - 0.01)
+    assert len(client.relay.sent) == 1
+    client.retransmit(first)
+    assert len(client.relay.sent) == 2
+    # The first retry waits RETRANSMIT_INTERVAL, the next twice as long.
+    assert client.retransmit_at > first + 0.4
+    assert client.retransmit_count == 2
+    confirm(client, 0)
+    assert not client.index_commands
+    assert client.retransmit_at is None
+
+
+def test_confirm_from_before_a_restart_renumbers():
+    client = make_client()
+    client.add_command('heal', 0)
+    client.add_command('quake', 0)
+    confirm(client, 41)
+    assert list(client.index_commands) == [(42, 'heal'), (43, 'quake')]
+    assert client.next_command_index == 44
+    client.send_commands()
+    assert last_commands(client) == [(42, 'heal'), (43, 'quake')]
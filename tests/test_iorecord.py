@@ -0,0 +1,68 @@
+import gzip
+
+import pytest
+
+from iorecord import (MAGIC, REQUEST, RESPONSE, TIMEOUT, Recorder,
+                      read_exchanges, read_session)
+
+
+def record(filename):
+    recorder = Recorder(str(filename))
+    recorder.record(REQUEST, b'READ_CORE_RAM 7e11e8 1')
+    recorder.record(RESPONSE, b'READ_CORE_RAM 7e11e8 04')
+    recorder.record(REQUEST, b'WRITE_CORE_RAM 7e11e8 06')
+    recorder.record(REQUEST, b'GET_STATUS')
+    recorder.record(TIMEOUT)
+    recorder.close()
+
+
+def test_round_trip(tmp_path):
+    filename = tmp_path / 'session.bin'
+    record(filename)
+    records = list(read_session(str(filename)))
+    assert [(kind, data) for (_, kind, data) in records] == [
+        (REQUEST, b'READ_CORE_RAM 7e11e8 1'),
+        (RESPONSE, b'READ_CORE_RAM 7e11e8 04'),
+        (REQUEST, b'WRITE_CORE_RAM 7e11e8 06'),
+        (REQUEST, b'GET_STATUS'),
+        (TIMEOUT, b'')]
+    times = [elapsed for (elapsed, _, _) in records]
+    assert times == sorted(times)
+    exchanges = read_exchanges(str(filename))
+    assert [(request, response) for (_, _, request, response)
+            in exchanges] == [
+        (b'READ_CORE_RAM 7e11e8 1', b'READ_CORE_RAM 7e11e8 04'),
+        (b'WRITE_CORE_RAM 7e11e8 06', None),
+        (b'GET_STATUS', None)]
+
+
+@pytest.mark.parametrize('cut', [1, 10, 20, 40])
+def test_truncated_file(tmp_path, cut):
+    # Cut the uncompressed stream partway through a record, then cut the
+    # gzip member short as a crash would.
+    filename = tmp_path / 'session.bin'
+    record(filename)
+    with gzip.open(str(filename), 'rb') as f:
+        data = f.read()
+    complete = list(read_session(str(filename)))
+    truncated = tmp_path / 'truncated.bin'
+    with open(str(truncated), 'wb') as f:
+        f.write(gzip.compress(data[:len(data) - cut])[:-8])
+    records = list(read_session(str(truncated)))
+    assert records == complete[:len(records)]
+    assert len(records) < len(complete)
+
+
+def test_truncated_header(tmp_path):
+    filename = tmp_path / 'session.bin'
+    with open(str(filename), 'wb') as f:
+        f.write(gzip.compress(MAGIC)[:-8])
+    assert list(read_session(str(filename))) == []
+
+
+def test_not_a_session(tmp_path):
+    filename = tmp_path / 'other.bin'
+    with gzip.open(str(filename), 'wb') as f:
+        f.write(b'something else entirely')
+    with pytest.raises(ValueError):
+        list(read_session(str(filename)))
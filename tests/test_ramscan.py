@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import ramscan
+from ramscan import find_runs
+
+
+def find_runs_pure(monkeypatch, old, new, gap=ramscan.MERGE_GAP):
+    monkeypatch.setattr(ramscan, 'numpy', None)
+    return find_runs(old, new, gap)
+
+
+def changed_copy(old, offsets):
+    new = bytearray(old)
+    for offset in offsets:
+        new[offset] ^= 0xff
+    return bytes(new)
+
+
+def test_no_changes(monkeypatch):
+    old = bytes(range(256)) * 4
+    assert find_runs_pure(monkeypatch, old, old) == []
+
+
+def test_runs_are_merged_across_small_gaps(monkeypatch):
+    old = bytes(0x200)
+    new = changed_copy(old, [0, 1, 6, 12, 0x3f, 0x40, 0x1ff])
+    assert find_runs_pure(monkeypatch, old, new, gap=4) == [
+        (0, 7), (12, 13), (0x3f, 0x41), (0x1ff, 0x200)]
+    assert find_runs_pure(monkeypatch, old, new, gap=0) == [
+        (0, 2), (6, 7), (12, 13), (0x3f, 0x41), (0x1ff, 0x200)]
+
+
+def test_run_spanning_blocks(monkeypatch):
+    length = ramscan.BLOCK_LENGTH
+    old = bytes(length * 3)
+    new = changed_copy(old, [length - 2, length + 1, (length * 2) + 3])
+    assert find_runs_pure(monkeypatch, old, new) == [
+        (length - 2, length + 2), ((length * 2) + 3, (length * 2) + 4)]
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_numpy_matches_pure_python(monkeypatch, seed):
+    pytest.importorskip('numpy')
+    rng = random.Random(seed)
+    old = bytes(rng.randrange(0x100) for _ in range(0x1000))
+    offsets = rng.sample(range(len(old)), rng.randrange(1, 200))
+    new = changed_copy(old, offsets)
+    for gap in [0, 1, ramscan.MERGE_GAP, 32]:
+        runs = find_runs(old, new, gap)
+        assert runs == find_runs_pure(monkeypatch, old, new, gap)
+        monkeypatch.undo()
@@ -0,0 +1,142 @@
+import pytest
+
+import ramtools
+from emulator_standin import EmulatorStandin
+from ramtools import (ParityClient, Session, WriteTransaction,
+                      apply_patches, assemble_ranges, coalesce_ranges,
+                      read_config)
+
+
+class Memory():
+    # Answers a WriteTransaction from a local copy of memory. Writes to an
+    # address in dropped are lost, as a datagram would be.
+    RETRY_INTERVAL = 0
+
+    def __init__(self):
+        self.memory = bytearray(0x1000000)
+        self.dropped = set([])
+        self.batches = []
+
+    def read_emulator(self, address, num_bytes):
+        return list(self.memory[address:address+num_bytes])
+
+    def read_ranges(self, ranges):
+        return [self.read_emulator(address, length)
+                for (address, length) in ranges]
+
+    def send_emulator_batch(self, writes):
+        self.batches.append(writes)
+        for address, data in writes:
+            if address not in self.dropped:
+                self.memory[address:address+len(data)] = bytes(data)
+
+
+def test_coalesce_ranges():
+    ranges = [(0x20, 4), (0x00, 4), (0x02, 8), (0x10, 2)]
+    assert coalesce_ranges(ranges) == [(0x00, 10), (0x10, 2), (0x20, 4)]
+    assert coalesce_ranges(ranges, gap=6) == [(0x00, 0x12), (0x20, 4)]
+    assert coalesce_ranges(ranges, gap=0x10) == [(0x00, 0x24)]
+    assert coalesce_ranges(ranges, gap=0x10, max_length=0x10) == [
+        (0x00, 0x10), (0x10, 0x10), (0x20, 4)]
+    assert coalesce_ranges([]) == []
+
+
+def test_coalesce_contained_range():
+    assert coalesce_ranges([(0x00, 0x10), (0x04, 2)]) == [(0x00, 0x10)]
+
+
+def test_assemble_ranges():
+    memory = list(range(0x40))
+    ranges = [(0x02, 4), (0x0e, 4), (0x30, 2), (0x08, 0)]
+    chunks = [(address, memory[address:address+length])
+              for (address, length) in coalesce_ranges(
+                  ranges, gap=8, max_length=0x0c)]
+    assert len(chunks) > 2
+    assert assemble_ranges(ranges, chunks) == [
+        memory[address:address+length] for (address, length) in ranges]
+
+
+def test_transaction_sends_untriggered_writes_without_reading():
+    client = Memory()
+    transaction = WriteTransaction(client)
+    transaction.write(0xc0d000, [1, 2, 3])
+    assert transaction.commit()
+    assert client.batches == [[(0xc0d000, [1, 2, 3])]]
+    assert transaction.backup == {}
+
+
+def test_transaction_rolls_back_when_verify_fails():
+    client = Memory()
+    client.memory[0xc0d000:0xc0d008] = bytes(range(1, 9))
+    client.dropped.add(0xc0d004)
+    transaction = WriteTransaction(client)
+    transaction.write(0xc0d000, [0xaa, 0xbb])
+    transaction.write(0xc0d004, [0xcc, 0xdd])
+    transaction.trigger(0x7e11e8, [0x04])
+    with pytest.raises(IOError):
+        transaction.commit()
+    assert list(client.memory[0xc0d000:0xc0d008]) == list(range(1, 9))
+    assert client.memory[0x7e11e8] == 0
+    assert (0x7e11e8, [0x04]) not in [w for b in client.batches for w in b]
+
+
+def test_transaction_rolls_back_when_expected_memory_changed():
+    client = Memory()
+    transaction = WriteTransaction(client)
+    transaction.write(0xc0d000, [0xaa])
+    transaction.expect(0x7ffe01, [0])
+    transaction.trigger_bits(0x7e11e8, set_bits=0x01)
+    client.memory[0x7ffe01] = 1
+    assert transaction.commit() is False
+    assert client.memory[0xc0d000] == 0
+    assert client.memory[0x7e11e8] == 0
+
+
+def test_transaction_trigger_bits_keep_other_bits():
+    client = Memory()
+    client.memory[0x7e11e8] = 0x44
+    transaction = WriteTransaction(client)
+    transaction.write(0x7e3420, [0x02, 0x30])
+    transaction.trigger_bits(0x7e11e8, set_bits=0x01, unset_bits=0x04)
+    assert transaction.commit()
+    assert client.memory[0x7e11e8] == 0x41
+    assert transaction.bits[0x7e11e8] == (0x44, 0x41)
+
+
+@pytest.fixture
+def session():
+    standin = EmulatorStandin(port=0).start()
+    session = Session('test', read_config(ramtools.CONFIG_FILENAME))
+    session.client = ParityClient('127.0.0.1', standin.port)
+    session.client.connect_emulator()
+    session.activate()
+    yield session
+    ramtools.default_session.activate()
+    standin.stop()
+
+
+def write_patch(tmp_path, name, lines):
+    filename = tmp_path / name
+    filename.write_text('\n'.join(lines) + '\n')
+    return str(filename)
+
+
+def test_apply_patches_allows_identical_overlap(session, tmp_path):
+    first = write_patch(tmp_path, 'first.patch', ['c0f000: a9 01 60'])
+    second = write_patch(tmp_path, 'second.patch', ['c0f002: 60 ea'])
+    patches = apply_patches([first, second])
+    assert all(p.applied_patch for p in patches)
+    assert session.installed_patches == patches
+    # Writes get no reply; a read answered after them sees them.
+    assert session.client.read_emulator(0xc0f000, 4) == [
+        0xa9, 0x01, 0x60, 0xea]
+
+
+def test_apply_patches_rejects_conflicting_writes(session, tmp_path):
+    first = write_patch(tmp_path, 'first.patch', ['c0f000: a9 01 60'])
+    second = write_patch(tmp_path, 'second.patch', ['c0f001: 02'])
+    with pytest.raises(Exception, match='Write conflict between patches '
+                                        'at c0f001'):
+        apply_patches([first, second])
+    assert session.client.read_emulator(0xc0f000, 3) == [0, 0, 0]
+    assert session.installed_patches == []
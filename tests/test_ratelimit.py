@@ -0,0 +1,58 @@
+import pytest
+
+from ratelimit import RateLimiter, TokenBucket, allow_all
+
+
+def test_bucket_starts_full_and_refills():
+    bucket = TokenBucket.per(3, 6)
+    now = bucket.updated
+    assert all(bucket.consume(now=now) for _ in range(3))
+    assert not bucket.consume(now=now)
+    assert bucket.wait_time(now=now) == 2
+    assert not bucket.consume(now=now + 1.9)
+    assert bucket.consume(now=now + 2.1)
+
+
+def test_bucket_never_exceeds_capacity():
+    bucket = TokenBucket(1, 2)
+    now = bucket.updated
+    bucket.refill(now + 100)
+    assert bucket.tokens == 2
+    assert bucket.consume(2, now=now + 100)
+    assert not bucket.consume(now=now + 100)
+
+
+def test_bucket_ignores_time_going_backwards():
+    bucket = TokenBucket(1, 1)
+    now = bucket.updated
+    assert bucket.consume(now=now)
+    assert not bucket.consume(now=now - 10)
+    assert bucket.wait_time(now=now - 10) == 1
+
+
+def test_limiter_keeps_a_bucket_per_key():
+    limiter = RateLimiter(1, 60)
+    assert limiter.allow('alice')
+    assert limiter.allow('bob')
+    assert not limiter.allow('alice')
+    assert limiter.rejected == 1
+
+
+def test_limiter_evicts_least_recently_used():
+    limiter = RateLimiter(1, 60)
+    limiter.MAX_KEYS = 2
+    limiter.allow('alice')
+    limiter.allow('bob')
+    limiter.get_bucket('alice')
+    limiter.allow('carol')
+    assert list(limiter.buckets) == ['alice', 'carol']
+
+
+def test_allow_all_only_spends_when_every_limiter_allows():
+    channel = RateLimiter(10, 60)
+    user = RateLimiter(1, 60)
+    assert allow_all([(channel, None), (user, 'alice')])
+    assert not allow_all([(channel, None), (user, 'alice')])
+    assert user.rejected == 1 and channel.rejected == 0
+    assert channel.get_bucket(None).tokens == pytest.approx(9, abs=0.01)
+    assert allow_all([(channel, None), (None, 'alice')])
@@ -0,0 +1,97 @@
+import pytest
+
+import relay_protocol
+
+
+@pytest.mark.parametrize('value', [0, 1, 0x7f, 0x80, 0x3fff, 0x4000,
+                                   0xffffffff, 2**64])
+def test_varint_round_trip(value):
+    data = relay_protocol.encode_varint(value)
+    assert relay_protocol.decode_varint(data + b'\xff', 0) == (value,
+                                                               len(data))
+
+
+def test_varint_lengths():
+    assert relay_protocol.encode_varint(0x7f) == b'\x7f'
+    assert relay_protocol.encode_varint(0x80) == b'\x80\x01'
+    assert len(relay_protocol.encode_varint(0x3fff)) == 2
+    assert len(relay_protocol.encode_varint(0x4000)) == 3
+
+
+def test_varint_rejects_negative():
+    with pytest.raises(AssertionError):
+        relay_protocol.encode_varint(-1)
+
+
+def test_truncated_string():
+    data = relay_protocol.encode_string('airstrike')[:-1]
+    with pytest.raises(ValueError):
+        relay_protocol.decode_string(data, 0)
+
+
+def test_small_message_is_not_compressed():
+    msg = relay_protocol.encode_message(relay_protocol.KEEPALIVE, b'abcd',
+                                        serial_number=300)
+    assert not msg[0] & relay_protocol.COMPRESSED
+    assert relay_protocol.decode_message(msg, has_serial=True) == (
+        relay_protocol.KEEPALIVE, 300, b'abcd')
+
+
+def test_compressed_message_round_trip():
+    table = ['airstrike', 'heal', 'quake', 'rename']
+    dictionary = relay_protocol.build_dictionary(table)
+    payload = relay_protocol.encode_commands(
+        7, ['quake', 'heal', 'airstrike'] * 20)
+    msg = relay_protocol.encode_message(relay_protocol.COMMANDS, payload,
+                                        dictionary=dictionary)
+    assert msg[0] & relay_protocol.COMPRESSED
+    assert len(msg) < len(payload)
+    message_type, serial_number, decoded = relay_protocol.decode_message(
+        msg, dictionary=dictionary)
+    assert (message_type, serial_number) == (relay_protocol.COMMANDS, None)
+    assert decoded == payload
+
+
+def test_incompressible_payload_is_sent_plain():
+    payload = bytes(range(0x100))
+    msg = relay_protocol.encode_message(relay_protocol.COMMANDS, payload)
+    assert msg[0] == relay_protocol.COMMANDS
+    assert relay_protocol.decode_message(msg)[2] == payload
+
+
+def test_commands_round_trip():
+    table = ['airstrike', 'heal', 'quake']
+    commands = [2, 'rename terra', 0, 'x' * 200]
+    payload = relay_protocol.encode_commands(128, commands)
+    assert relay_protocol.decode_commands(payload, table) == [
+        (128, 'quake'), (129, 'rename terra'), (130, 'airstrike'),
+        (131, 'x' * 200)]
+    header = (relay_protocol.encode_varint(128)
+              + relay_protocol.encode_varint(len(commands)))
+    assert sum(relay_protocol.command_length(c) for c in commands) == (
+        len(payload) - len(header))
+
+
+def test_report_round_trip():
+    table = ['airstrike', 'heal', 'quake']
+    payload = relay_protocol.encode_report(
+        'channel', ['alice', 'bob'], table,
+        rate_limits={'user': (3, 60), 'command': (10, 5)},
+        allowed_commands=['heal', 'quake'])
+    assert relay_protocol.decode_report(payload) == (
+        'channel', ['alice', 'bob'], table, ['heal', 'quake'],
+        {'user': (3, 60), 'command': (10, 5)})
+
+
+@pytest.mark.parametrize('confirmed', [-1, 0, 127, 128, 100000])
+def test_confirm_round_trip(confirmed):
+    payload = relay_protocol.encode_confirm(confirmed)
+    assert relay_protocol.decode_confirm(payload) == confirmed
+
+
+def test_keepalive():
+    digest = relay_protocol.command_digest(['quake', 'heal'])
+    assert digest == relay_protocol.command_digest(['heal', 'quake'])
+    payload = relay_protocol.encode_keepalive(digest)
+    assert relay_protocol.decode_keepalive(payload) == digest
+    assert relay_protocol.decode_keepalive(payload[:3]) is None
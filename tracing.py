@@ -0,0 +1,106 @@
+import csv
+import json
+from io import StringIO
+from os import getpid
+from threading import get_ident
+from time import perf_counter
+
+from logwriter import LogWriter
+
+CSV_COLUMNS = ['name', 'category', 'start', 'duration', 'thread', 'args']
+
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.complete(self.name, self.category, self.start,
+                             perf_counter(), **self.args)
+        return False
+
+    def __setitem__(self, key, value):
+        self.args[key] = value
+
+
+class Tracer():
+    # Spans are written as they finish, either as Chrome trace events
+    # (load the .json file in chrome://tracing or Perfetto) or as CSV rows.
+    def __init__(self):
+        self.writer = None
+        self.csv = False
+        self.origin = perf_counter()
+        self.pid = getpid()
+
+    @property
+    def enabled(self):
+        return self.writer is not None
+
+    def open(self, filename):
+        self.close()
+        self.csv = filename.lower().endswith('.csv')
+        self.writer = LogWriter(filename, max_bytes=0)
+        if self.writer.size == 0:
+            if self.csv:
+                self.writer.write(','.join(CSV_COLUMNS) + '\n')
+            else:
+                self.writer.write('[\n')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def span(self, name, category, **args):
+        if self.writer is None:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def complete(self, name, category, start, end, **args):
+        if self.writer is None:
+            return
+        ts = (start - self.origin) * 1000000
+        duration = (end - start) * 1000000
+        if self.csv:
+            row = [name, category, '{0:.0f}'.format(ts),
+                   '{0:.0f}'.format(duration), str(get_ident()),
+                   ' '.join('{0}={1}'.format(k, v)
+                            for (k, v) in sorted(args.items()))]
+            s = StringIO()
+            csv.writer(s, lineterminator='\n').writerow(row)
+            self.writer.write(s.getvalue())
+        else:
+            event = {'name': name, 'cat': category, 'ph': 'X',
+                     'ts': round(ts), 'dur': round(duration),
+                     'pid': self.pid, 'tid': get_ident(), 'args': args}
+            self.writer.write(json.dumps(event) + ',\n')
+
+    def instant(self, name, category, **args):
+        now = perf_counter()
+        self.complete(name, category, now, now, **args)
+
+
+tracer = Tracer()